@@ -0,0 +1,169 @@
+"""
+Benchmark of the throttling hot path: get_buckets + check_throttle + commit_request.
+
+Every combination of --rules, --keys, --threads, --processes and --periods is measured separately,
+results are appended to --output as JSON lines and can be compared with a previous run:
+
+    python bench.py --backend memory --rules 1,3 --keys 1,10000 --threads 1,8
+    python bench.py --backend memory --rules 1,3 --keys 1,10000 --threads 1,8 \
+        --output new.txt --compare bench_output.txt
+
+Backends:
+    memory         - bucket_throttling.backends.MemoryBackend
+    sharded-memory - ShardedBackend over 4 MemoryBackend nodes
+    fakeredis      - in-process redis stand-in (pip install fakeredis[lua])
+    redis          - redis server at --redis-url (e.g. a locally spawned redis-server)
+
+In-process backends are not shared between processes: with --processes > 1 every process throttles its own buckets.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+
+from bucket_throttling import ThrottlingOptions, ThrottlingRule
+from bucket_throttling.backends import MemoryBackend, ShardedBackend
+from bucket_throttling.utils import get_buckets, check_throttle, commit_request
+
+BACKENDS = ('memory', 'sharded-memory', 'fakeredis', 'redis')
+
+
+def make_options(args, periods_to_overtake: int) -> ThrottlingOptions:
+    options = dict(periods_to_overtake=periods_to_overtake, use_script=args.use_script)
+    if args.backend == 'memory':
+        options['backend'] = MemoryBackend()
+    elif args.backend == 'sharded-memory':
+        options['backend'] = ShardedBackend(clients=[MemoryBackend() for i in range(4)])
+    elif args.backend == 'fakeredis':
+        import fakeredis
+        options['redis_instance'] = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+    else:
+        import redis
+        options['redis_instance'] = redis.StrictRedis.from_url(args.redis_url)
+    return ThrottlingOptions(**options)
+
+
+def make_rules(count: int, max_requests: int) -> list:
+    return [ThrottlingRule(max_requests=max_requests, interval=60 * (i + 1)) for i in range(count)]
+
+
+def run_thread(options: ThrottlingOptions, rules: list, keys: int, requests: int, seed: int, latencies: list):
+    rnd = random.Random(seed)
+    clock = time.perf_counter
+    ret = []
+    for i in range(requests):
+        arguments = {'user': rnd.randrange(keys), 'view': 'bench'}
+        started = clock()
+        buckets = get_buckets(rules, arguments, options)
+        if not check_throttle(buckets):
+            commit_request(buckets)
+        ret.append(clock() - started)
+    latencies.extend(ret)
+
+
+def run_process(args, case: dict, seed: int) -> tuple:
+    """Runs case['threads'] threads over shared options, returns (latencies, elapsed seconds)"""
+    options = make_options(args, case['periods'])
+    rules = make_rules(case['rules'], args.max_requests)
+    latencies = []
+    threads = [threading.Thread(target=run_thread,
+                                args=(options, rules, case['keys'], args.requests, seed + i, latencies))
+               for i in range(case['threads'])]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, time.perf_counter() - started
+
+
+def percentile(values: list, p: float) -> float:
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def run_case(args, case: dict) -> dict:
+    if case['processes'] == 1:
+        results = [run_process(args, case, args.seed)]
+    else:
+        with multiprocessing.Pool(case['processes']) as pool:
+            results = pool.starmap(run_process, [(args, case, args.seed + 1000 * i)
+                                                 for i in range(case['processes'])])
+    latencies = sorted(itertools.chain.from_iterable(r[0] for r in results))
+    elapsed = max(r[1] for r in results)
+    ret = dict(case, backend=args.backend, use_script=args.use_script, requests=len(latencies))
+    ret['rps'] = round(len(latencies) / elapsed, 1)
+    for p in (50, 90, 99):
+        ret['p%d_ms' % p] = round(percentile(latencies, p) * 1000, 4)
+    ret['max_ms'] = round(latencies[-1] * 1000, 4)
+    return ret
+
+
+def case_id(result: dict) -> tuple:
+    return tuple(result[k] for k in ('backend', 'use_script', 'rules', 'keys', 'threads', 'processes', 'periods'))
+
+
+def compare(results: list, path: str):
+    """Prints throughput and p99 change relative to results stored in path"""
+    with open(path) as f:
+        previous = {case_id(r): r for r in map(json.loads, f) if 'rps' in r}
+    print('\nCompared to %s:' % path)
+    for r in results:
+        old = previous.get(case_id(r))
+        if old is None:
+            continue
+        print('%-70s rps %+7.1f%%  p99 %+7.1f%%' % (
+            ' '.join('%s=%s' % (k, v) for k, v in zip(('backend', 'script', 'rules', 'keys', 'threads',
+                                                       'processes', 'periods'), case_id(r))),
+            (r['rps'] / old['rps'] - 1) * 100,
+            (r['p99_ms'] / old['p99_ms'] - 1) * 100 if old['p99_ms'] else 0))
+
+
+def int_list(value: str) -> list:
+    return [int(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the throttling hot path')
+    parser.add_argument('--backend', choices=BACKENDS, default='memory')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--use-script', action='store_true', help='check buckets with CHECK_AND_COMMIT script')
+    parser.add_argument('--rules', type=int_list, default=[1, 3], help='rules per request')
+    parser.add_argument('--keys', type=int_list, default=[1, 10000], help='distinct throttling arguments')
+    parser.add_argument('--threads', type=int_list, default=[1, 4], help='threads per process')
+    parser.add_argument('--processes', type=int_list, default=[1])
+    parser.add_argument('--periods', type=int_list, default=[0], help='values of periods_to_overtake')
+    parser.add_argument('--requests', type=int, default=5000, help='requests per thread')
+    parser.add_argument('--max-requests', type=int, default=10 ** 9,
+                        help='max_requests of rules (default never throttles)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_output.txt', help='file to append JSON results to')
+    parser.add_argument('--compare', help='previous output file')
+    args = parser.parse_args()
+
+    meta = dict(started_at=datetime.now().isoformat(timespec='seconds'), python=sys.version.split()[0],
+                platform=platform.platform(), argv=sys.argv[1:])
+    results = []
+    with open(args.output, 'a') as output:
+        output.write(json.dumps(meta) + '\n')
+        for rules, keys, threads, processes, periods in itertools.product(
+                args.rules, args.keys, args.threads, args.processes, args.periods):
+            case = dict(rules=rules, keys=keys, threads=threads, processes=processes, periods=periods)
+            result = run_case(args, case)
+            results.append(result)
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            print('rules=%(rules)d keys=%(keys)d threads=%(threads)d processes=%(processes)d periods=%(periods)d: '
+                  '%(rps).0f req/s, p50 %(p50_ms).3f ms, p99 %(p99_ms).3f ms' % result)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
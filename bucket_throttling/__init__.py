@@ -1,7 +1,17 @@
+import atexit
+import hashlib
+import time
 import redis as r
 
-from datetime import datetime, timedelta
+from datetime import timedelta
 
+from . import connections
+from .backends import BaseBackend
+from .breaker import CircuitBreaker, GuardedStorage, AsyncGuardedStorage
+from .cache import ThrottledCache
+from .lease import LeaseStore
+from .metrics import Metrics, LoggingMetrics, InstrumentedStorage, AsyncInstrumentedStorage
+from .scripts import CHECK_AND_COMMIT, LEASE, RETURN_LEASE
 from .translation import localize_timedelta
 
 
@@ -15,11 +25,33 @@ def build_cache_key(**arguments) -> str:
     >>> build_cache_key(user=User('vasya man'), scope=Organization('Org1'))
     'scope;Организация:_Org1;user;vasya_man'
     """
-    parts = []
-    for k in sorted(arguments):
-        parts.append(k)
-        parts.append(arguments[k])
-    return ';'.join(map(lambda s: str(s).replace(' ', '_'), parts))
+    return ';'.join(['%s;%s' % (k, arguments[k]) for k in sorted(arguments)]).replace(' ', '_')
+
+
+def hash_cache_key(key: str) -> str:
+    """
+    Ключ фиксированной длины (32 символа) для ключей произвольной длины
+
+    >>> hash_cache_key('arg1;value1;arg2;value2')
+    'cc747f905ccc7191af65d60454143351'
+    """
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+class KeyTemplate:
+    """
+    Заранее скомпилированный build_cache_key для фиксированного набора имён аргументов
+
+    >>> KeyTemplate('user', 'method').build({'user': 1, 'method': 'GET'})
+    'method;GET;user;1'
+    """
+
+    def __init__(self, *names):
+        self.names = tuple(sorted(names))
+        self.template = ';'.join('%s;%%s' % name.replace('%', '%%') for name in self.names).replace(' ', '_')
+
+    def build(self, arguments: dict) -> str:
+        return (self.template % tuple([arguments[name] for name in self.names])).replace(' ', '_')
 
 
 class ThrottlingOptions:
@@ -30,27 +62,260 @@ class ThrottlingOptions:
 
     periods_to_overtake - кол-во периодов, неиспользованную ёмкость которых пользователь
                           может наверстать путём совершения запросов.
-    redis_instance      - StrictRedis instance. Если не задан, создаётся автоматически.
+    redis_instance      - StrictRedis instance. Если не задан, создаётся автоматически и разделяется
+                          всеми ThrottlingOptions с теми же настройками подключения (см. connections).
+                          После fork() дочерний процесс создаёт своего клиента.
     redis_options       - словарь настроек для конструктора StrictRedis.
-    verbose_mode        - писать отладочную информацию в print или нет
+    backend             - хранилище вёдер вместо redis (например, backends.MemoryBackend).
+    verbose_mode        - писать решения и события вёдер в logging (metrics.LoggingMetrics), если metrics не задан
+    use_script          - проверять и фиксировать запросы одним атомарным вызовом Lua-скрипта
+                          (см. ScriptedThrottlingBucket)
+    throttled_cache     - локальный кэш переполненных вёдер (cache.ThrottledCache): пока ведро в нём,
+                          запросы отклоняются без обращения к хранилищу.
+    hashed_keys         - заменять аргументы в ключах вёдер хэшем фиксированной длины (см. hash_cache_key)
+    cluster             - подключаться к Redis Cluster (redis>=4.1): redis_options передаются в RedisCluster.
+                          Ключи вёдер содержат hash tag, поэтому вёдра одного набора аргументов
+                          попадают в один слот.
+    metrics             - получатель метрик (metrics.Metrics): решения по правилам, события вёдер
+                          и длительность обращений к хранилищу.
+    timeout             - таймаут соединения и ответа redis (сек), без повторов запроса после ошибки.
+                          По умолчанию используются настройки клиента redis
+    breaker             - переключение на запасное хранилище при недоступности redis (breaker.CircuitBreaker)
+    clock               - функция текущего времени (unix timestamp, сек)
+    server_time         - скрипты берут время из хранилища (команда TIME в redis), а не из clock процесса,
+                          поэтому расхождение часов между серверами не влияет на решения.
+                          Относится к вёдрам, проверяемым скриптом (см. use_script)
+    max_connections     - максимальное кол-во соединений в пуле клиента redis
+    health_check_interval - проверять соединение, простоявшее в пуле дольше этого интервала (сек),
+                          перед его использованием
     """
     periods_to_overtake = 0
     redis_instance = None
     redis_options = {}
+    backend = None
     verbose_mode = False
+    use_script = False
+    throttled_cache = None
+    hashed_keys = False
+    cluster = False
+    metrics = None
+    timeout = None
+    breaker = None
+    clock = time.time
+    server_time = False
+    max_connections = None
+    health_check_interval = None
+    owned_client = False
+    client_generation = 0
+    wrapped_instance = None
+    script_instances = None
+    async_redis_instance = None
+    async_script_instances = None
+    lease_store = None
 
-    def __init__(self, periods_to_overtake=0, redis_instance=None, redis_options=None, verbose_mode=False):
+    def __init__(self, periods_to_overtake=0, redis_instance=None, redis_options=None, verbose_mode=False,
+                 use_script=False, backend: BaseBackend=None, throttled_cache: ThrottledCache=None,
+                 hashed_keys=False, cluster=False, metrics: Metrics=None, timeout: float=None,
+                 breaker: CircuitBreaker=None, clock=time.time, server_time=False, max_connections: int=None,
+                 health_check_interval: float=None):
         self.periods_to_overtake = periods_to_overtake
         self.redis_instance = redis_instance
         self.redis_options = redis_options or {}
+        self.backend = backend
         self.verbose_mode = verbose_mode
+        self.use_script = use_script
+        self.throttled_cache = throttled_cache
+        self.hashed_keys = hashed_keys
+        self.cluster = cluster
+        if metrics is None and verbose_mode:
+            metrics = LoggingMetrics()
+        self.metrics = metrics
+        self.timeout = timeout
+        self.breaker = breaker
+        self.clock = clock
+        self.server_time = server_time
+        self.max_connections = max_connections
+        self.health_check_interval = health_check_interval
+
+    def _check_fork(self):
+        """В дочернем процессе после fork() клиенты, скрипты и аренды родителя не используются"""
+        self.client_generation = connections.generation
+        if self.owned_client:
+            self.redis_instance = None
+            self.owned_client = False
+        self.wrapped_instance = self.script_instances = None
+        self.async_redis_instance = self.async_script_instances = None
+        # неизрасходованные токены аренд вернёт в хранилище родитель
+        self.lease_store = None
 
     @property
     def redis(self):
+        """
+        Хранилище вёдер. Если задан metrics, обращения к нему измеряются,
+        если задан breaker - при ошибках переключаются на запасное хранилище
+        """
+        if self.metrics is None and self.breaker is None:
+            return self.storage
+        if self.client_generation != connections.generation:
+            self._check_fork()
+        if self.wrapped_instance is None:
+            self.wrapped_instance = self._wrap(self.storage, InstrumentedStorage, GuardedStorage)
+        return self.wrapped_instance
+
+    def _wrap(self, storage, instrumented_class, guarded_class):
+        if self.metrics is not None:
+            storage = instrumented_class(storage, self.metrics)
+        if self.breaker is not None:
+            storage = guarded_class(storage, self.breaker, self.ping)
+        return storage
+
+    def ping(self):
+        """Проверка доступности хранилища в обход breaker"""
+        return self.storage.ping()
+
+    def client_options(self, asynchronous=False) -> dict:
+        """Настройки для конструктора клиента redis: redis_options с учётом timeout и настроек пула"""
+        defaults = {}
+        if self.max_connections is not None:
+            defaults['max_connections'] = self.max_connections
+        if self.health_check_interval is not None:
+            defaults['health_check_interval'] = self.health_check_interval
+        if self.timeout is not None:
+            from redis.backoff import NoBackoff
+            if asynchronous:
+                from redis.asyncio.retry import Retry
+            else:
+                from redis.retry import Retry
+            # время ожидания ограничено timeout, поэтому запросы после ошибки не повторяются
+            defaults.update(socket_timeout=self.timeout, socket_connect_timeout=self.timeout,
+                            retry=Retry(NoBackoff(), 0))
+        if not defaults:
+            return self.redis_options
+        return dict(defaults, **self.redis_options)
+
+    def client_key(self) -> tuple:
+        """Настройки подключения, по которым клиент redis разделяется между ThrottlingOptions"""
+        return (self.cluster, repr(sorted(self.redis_options.items())), self.timeout, self.max_connections,
+                self.health_check_interval)
+
+    def _create_client(self):
+        if self.cluster:
+            # клиент сам обновляет карту слотов при переключении узлов (MOVED / ошибки соединения)
+            from redis.cluster import RedisCluster
+            return RedisCluster(**self.client_options())
+        return r.StrictRedis(**self.client_options())
+
+    @property
+    def storage(self):
+        """Хранилище вёдер: backend, если задан, иначе StrictRedis (или RedisCluster)"""
+        if self.backend is not None:
+            return self.backend
+        if self.client_generation != connections.generation:
+            self._check_fork()
         if not self.redis_instance:
-            self.redis_instance = r.StrictRedis(**self.redis_options)
+            self.redis_instance = connections.get_client(self.client_key(), self._create_client)
+            self.owned_client = True
         return self.redis_instance
 
+    @property
+    def use_hash_tags(self) -> bool:
+        """Ключи вёдер должны содержать общий для набора аргументов hash tag"""
+        return self.cluster or (self.backend is not None and self.backend.requires_hash_tags)
+
+    @property
+    def transactions(self) -> bool:
+        """Можно ли использовать транзакционный pipeline (MULTI/EXEC)"""
+        return not self.cluster
+
+    def script_now(self) -> str:
+        """Текущее время для скриптов: пустая строка означает время хранилища (см. server_time)"""
+        return '' if self.server_time else repr(self.clock())
+
+    def script(self, source: str):
+        """Скрипт из scripts.py, зарегистрированный в хранилище (вызывается через EVALSHA)"""
+        if self.client_generation != connections.generation:
+            self._check_fork()
+        if self.script_instances is None:
+            self.script_instances = {}
+        if source not in self.script_instances:
+            self.script_instances[source] = self.redis.register_script(source)
+        return self.script_instances[source]
+
+    @property
+    def async_redis(self):
+        """
+        Клиент redis.asyncio (redis>=4.2), создаётся из redis_options.
+        Все асинхронные вёдра с этими настройками используют его общий пул соединений.
+        В отличие от синхронного клиента, он не разделяется с другими ThrottlingOptions:
+        соединения redis.asyncio привязаны к event loop.
+        """
+        if self.client_generation != connections.generation:
+            self._check_fork()
+        if not self.async_redis_instance:
+            if self.backend is not None:
+                self.async_redis_instance = self.backend.as_async()
+            elif self.cluster:
+                from redis.asyncio.cluster import RedisCluster
+                self.async_redis_instance = RedisCluster(**self.client_options(asynchronous=True))
+            else:
+                from redis import asyncio as aioredis
+                self.async_redis_instance = aioredis.StrictRedis(**self.client_options(asynchronous=True))
+            self.async_redis_instance = self._wrap(self.async_redis_instance, AsyncInstrumentedStorage,
+                                                   AsyncGuardedStorage)
+        return self.async_redis_instance
+
+    def async_script(self, source: str):
+        if self.client_generation != connections.generation:
+            self._check_fork()
+        if self.async_script_instances is None:
+            self.async_script_instances = {}
+        if source not in self.async_script_instances:
+            self.async_script_instances[source] = self.async_redis.register_script(source)
+        return self.async_script_instances[source]
+
+    @property
+    def leases(self) -> LeaseStore:
+        """Аренды токенов процесса (см. ThrottlingRule.lease_size). Возвращаются в хранилище при выходе"""
+        if self.client_generation != connections.generation:
+            self._check_fork()
+        if self.lease_store is None:
+            self.lease_store = LeaseStore()
+            atexit.register(self.return_leases)
+        return self.lease_store
+
+    def return_leases(self):
+        """Возвращает в хранилище неизрасходованные токены всех аренд"""
+        if self.client_generation != connections.generation:
+            # обработчик atexit унаследован от родителя: аренды родителя вернёт он сам
+            self._check_fork()
+        if self.lease_store is None:
+            return
+        for key, lease in self.lease_store.pop_all():
+            if lease.tokens > 0:
+                self.script(RETURN_LEASE)(keys=[key], args=[lease.stamp, lease.tokens])
+
+    def arguments_key(self, arguments_bundle: dict, key_template: KeyTemplate=None) -> str:
+        """Часть ключа ведра, построенная из аргументов запроса"""
+        key = key_template.build(arguments_bundle) if key_template else build_cache_key(**arguments_bundle)
+        return hash_cache_key(key) if self.hashed_keys else key
+
+    def get_bucket_class(self, rule, use_script: bool=None):
+        """:param use_script: проверять ведро скриптом независимо от настройки use_script"""
+        if rule.requires_script:
+            return ScriptedThrottlingBucket
+        if rule.lease_size:
+            return LeasedThrottlingBucket
+        return ScriptedThrottlingBucket if (self.use_script if use_script is None else use_script) else ThrottlingBucket
+
+    def get_async_bucket_class(self, rule, use_script: bool=None):
+        if rule.requires_script:
+            return AsyncScriptedThrottlingBucket
+        if rule.lease_size:
+            return AsyncLeasedThrottlingBucket
+        if self.use_script if use_script is None else use_script:
+            return AsyncScriptedThrottlingBucket
+        return AsyncThrottlingBucket
+
 
 defaultThrottlingOptions = ThrottlingOptions()
 
@@ -60,24 +325,92 @@ class ThrottlingRule:
     Класс с двумя переменными, характеризующими частоту запросов:
     1) кол-во запросов
     2) интервал времени
+
+    lease_size - если задан, процесс резервирует в хранилище сразу столько токенов и списывает
+                 запросы с них локально (см. LeasedThrottlingBucket). Это снижает нагрузку на хранилище
+                 для очень частых запросов ценой точности: каждый процесс может удерживать
+                 до lease_size - 1 неизрасходованных токенов в течение интервала.
+    scope      - имена аргументов запроса, из которых строится ключ ведра (по умолчанию все аргументы).
+                 Правила с разными scope образуют иерархию квот: например, ведро организации (scope=['org'])
+                 и ведро пользователя (scope=['org', 'user']) проверяются и списываются вместе
+                 (см. utils.BucketGroup.throttled_rules).
+
+    Ёмкость ведра пополняется целиком раз в интервал (см. ThrottlingBucket.commit_request).
+    Другие алгоритмы задаются подклассами: GCRARule, SlidingWindowRule.
     """
+    algorithm = 'bucket'
+    requires_script = False
     max_requests = None
     interval = None
+    seconds = None
+    lease_size = 0
+    scope = None
+    _cache_key = None
 
-    def __init__(self, max_requests: int, interval: [timedelta, int]):
+    def __init__(self, max_requests: int, interval: [timedelta, int], lease_size: int = 0, scope: list = None):
         self.max_requests = max_requests
+        self.lease_size = lease_size
         if isinstance(interval, timedelta):
             self.interval = interval
         else:
             self.interval = timedelta(seconds=interval)
+        self.seconds = self.interval.total_seconds()
+        if scope:
+            self.scope = tuple(sorted(scope))
+
+    def scope_arguments(self, arguments_bundle: dict) -> dict:
+        """Аргументы запроса, из которых строится ключ ведра правила"""
+        if self.scope is None:
+            return arguments_bundle
+        return {name: arguments_bundle[name] for name in self.scope}
+
+    @property
+    def rate(self) -> float:
+        """Допустимое кол-во запросов в секунду: чем оно меньше, тем строже правило"""
+        return self.max_requests / self.seconds
 
     def __str__(self):
-        return 'ThrottlingRule: %d requests per %s' % (self.max_requests,
-                                                       localize_timedelta(self.interval))
+        return '%s: %d requests per %s' % (self.__class__.__name__, self.max_requests,
+                                           localize_timedelta(self.interval))
 
     @property
     def cache_key(self) -> str:
-        return build_cache_key(requests=self.max_requests, per=self.interval)
+        """Часть ключа ведра, построенная из правила. Вычисляется один раз"""
+        if self._cache_key is None:
+            if self.algorithm == ThrottlingRule.algorithm:
+                self._cache_key = build_cache_key(requests=self.max_requests, per=self.interval)
+            else:
+                self._cache_key = build_cache_key(algorithm=self.algorithm, requests=self.max_requests,
+                                                  per=self.interval)
+        return self._cache_key
+
+
+class GCRARule(ThrottlingRule):
+    """
+    Правило, проверяемое по Generic Cell Rate Algorithm: запросы равномерно расходуют интервал,
+    допускается всплеск не более max_requests запросов. Состояние ведра - одно число
+    (theoretical arrival time), проверка и запись выполняются одним вызовом скрипта.
+    periods_to_overtake и lease_size к таким правилам не применяются.
+    """
+    algorithm = 'gcra'
+    requires_script = True
+
+    def __init__(self, max_requests: int, interval: [timedelta, int], scope: list = None):
+        super().__init__(max_requests, interval, scope=scope)
+
+
+class SlidingWindowRule(ThrottlingRule):
+    """
+    Правило со скользящим окном: кол-во запросов за последний интервал оценивается по счётчикам
+    текущего и предыдущего окна, взвешенным по прошедшей доле окна. В отличие от ThrottlingRule,
+    ёмкость не восстанавливается целиком на границе интервала.
+    periods_to_overtake и lease_size к таким правилам не применяются.
+    """
+    algorithm = 'window'
+    requires_script = True
+
+    def __init__(self, max_requests: int, interval: [timedelta, int], scope: list = None):
+        super().__init__(max_requests, interval, scope=scope)
 
 
 class ThrottlingBucket:
@@ -88,79 +421,420 @@ class ThrottlingBucket:
     rule = None
     request = None
     options = None
+    cost = 1
+    timeout = None
+    remaining = None
+    reset_after = None
 
-    def __init__(self, rule: ThrottlingRule, arguments_bundle: dict, options: ThrottlingOptions=None):
+    def __init__(self, rule: ThrottlingRule, arguments_bundle: dict, options: ThrottlingOptions=None, load=False,
+                 arguments_key: str=None, cost: int=1, hash_tag: str=None):
+        """
+        :param load: прочитать состояние ведра из кэша сразу. По умолчанию состояние читается при первом
+                     обращении к нему (см. state) или передаётся через set_state() (см. utils.BucketGroup),
+                     поэтому вёдра, до проверки которых дело не дошло, не читаются вовсе.
+        :param arguments_key: заранее построенный ThrottlingOptions.arguments_key() для аргументов правила
+        :param cost: кол-во токенов, списываемых запросом
+        :param hash_tag: общий hash tag вёдер запроса, если ключи аргументов правил различаются
+                         (см. ThrottlingRule.scope)
+        """
         self.options = options or defaultThrottlingOptions
-        self.base_key = 'THROTTLING:%s%s' % (rule.cache_key, build_cache_key(**arguments_bundle))
+        if arguments_key is None:
+            arguments_key = self.options.arguments_key(rule.scope_arguments(arguments_bundle))
+        if not self.options.use_hash_tags:
+            self.base_key = 'THROTTLING:%s%s' % (rule.cache_key, arguments_key)
+        elif hash_tag is None or hash_tag == arguments_key:
+            self.base_key = 'THROTTLING:{%s}%s' % (arguments_key or '_', rule.cache_key)
+        else:
+            self.base_key = 'THROTTLING:{%s}%s%s' % (hash_tag or '_', rule.cache_key, arguments_key)
         self.rule = rule
-        self.cache_dict = {k.decode(): v for (k, v) in self._redis.hgetall(self.base_key).items()}
+        self.cost = cost
+        if load and not self.local_throttle():
+            self.set_state(self._load())
+
+    def _load(self) -> dict:
+        return self._redis.hgetall(self.base_key)
+
+    def set_state(self, raw: dict):
+        """Принимает результат HGETALL для ключа ведра"""
+        self.cache_dict = {k.decode(): v for (k, v) in raw.items()}
+
+    @property
+    def loaded(self) -> bool:
+        """Состояние ведра уже прочитано, и его проверка не обращается к хранилищу"""
+        return self.cache_dict is not None
+
+    @property
+    def state(self) -> dict:
+        """Состояние ведра, прочитанное из кэша при первом обращении"""
+        if self.cache_dict is None:
+            self.set_state(self._load())
+        return self.cache_dict
 
     @property
     def _capacity(self) -> [None, int]:
         """Оставшаяся ёмкость ведра"""
-        d = self.cache_dict.get(self.capacity_key)
+        d = self.state.get(self.capacity_key)
         return int(d) if d is not None else d
 
     @property
-    def _updated_at(self) -> [None, timedelta]:
-        """Время обновления ведра"""
-        d = self.cache_dict.get(self.updated_at_key)
-        return datetime.fromtimestamp(float(d)) if d is not None else d
+    def _updated_at(self) -> [None, float]:
+        """Время обновления ведра (unix timestamp, сек)"""
+        d = self.state.get(self.updated_at_key)
+        return float(d) if d is not None else d
+
+    @property
+    def _cache_interval(self) -> int:
+        """Таймаут ведра в кэше (сек)"""
+        return max(int(self.rule.seconds * (self.options.periods_to_overtake + 1)), 1)
 
     @property
     def _redis(self):
         return self.options.redis
 
-    def _log(self, *msg):
-        if self.options.verbose_mode:
-            print(*msg)
+    def _report(self, timeout: [None, timedelta]) -> [None, timedelta]:
+        """Запоминает результат проверки ведра и сообщает его metrics"""
+        self.timeout = timeout
+        if self.options.metrics is not None:
+            self.options.metrics.decision(self.rule, self.base_key, timeout)
+        return timeout
+
+    def _event(self, event: str, capacity: int):
+        """Сообщает metrics об изменении ведра (см. Metrics.bucket_event)"""
+        if self.options.metrics is not None:
+            self.options.metrics.bucket_event(self.rule, self.base_key, event, capacity)
+
+    def local_throttle(self) -> [None, timedelta]:
+        """Интервал ожидания из локального кэша переполненных вёдер (см. ThrottlingOptions.throttled_cache)"""
+        if self.options.throttled_cache is not None:
+            return self.options.throttled_cache.get(self.base_key)
+
+    def _remember_throttle(self, timeout: timedelta, remaining: int):
+        """
+        Запоминает переполненное ведро в локальном кэше, только если оно не пропустит и запрос стоимостью 1:
+        пока в ведре есть токены, запросы меньшей стоимости, чем отклонённый, должны проверяться
+        """
+        if self.options.throttled_cache is not None and remaining < 1:
+            self.options.throttled_cache.set(self.base_key, timeout)
 
     def check_throttle(self) -> [None, timedelta]:
         """
         Возвращает None, если лимит ведра не превышен,
         иначе интервал времени, через который ведро опустеет
         """
+        timeout = self.local_throttle()
+        if timeout:
+            return self._report(timeout)
+
+        # вычисления ведутся в секундах, timedelta создаётся только для результата
         updated_at = self._updated_at
-        now = datetime.utcnow()
-        if self._capacity == 0 and updated_at is not None and updated_at + self.rule.interval > now:
-            return updated_at + self.rule.interval - now
-        return None
+        capacity = self._capacity or 0
+        remaining = updated_at + self.rule.seconds - self.options.clock() if updated_at is not None else 0
+        if remaining > 0:
+            self.remaining, self.reset_after = capacity, timedelta(seconds=remaining)
+            if capacity < self.cost:
+                timeout = self.reset_after
+        else:
+            self.remaining = self.rule.max_requests + (capacity if updated_at is not None else 0)
+            if self.cost > self.remaining:
+                # стоимость запроса больше, чем ведро может вместить после пополнения
+                timeout = self.rule.interval
+        if timeout:
+            self._remember_throttle(timeout, self.remaining)
+        return self._report(timeout)
 
-    def commit_request(self):
+    def commit_request(self, pipeline=None):
         """
         Обновляет значения в кэше, относящиеся к данному ведру.
-        Если в кэше ведра нет, создаём его с текущим timestamp и ёмкостью, меньшей максимальной на 1.
+        Если в кэше ведра нет, создаём его с текущим timestamp и ёмкостью, меньшей максимальной на cost.
         Если ведро обновлялось раньше, чем истёк его интервал действия, наращиваем его ёмкость и обновляем дату обновления.
-        Если ведро актуально, уменьшаем его ёмкость на 1.
+        Если ведро актуально, уменьшаем его ёмкость на cost.
 
         Мы предполагаем, что пользователь не злоумышленник, поэтому даём ему возможность совершать больше
         реквестов в отведённый интервал, если у ведра осталась неиспользованная емкость и задан periods_to_overtake > 0.
         Сделав таймаут кэша равным нескольким интервалам действия ведра, мы
         ограничим возможность наверстать его неиспользованную ёмкость.
+
+        :param pipeline: redis pipeline, в который будут добавлены команды записи (исполняет вызывающий)
         """
+        incremented = None
+        if self._updated_at is None and self._capacity is not None:
+            # во избежание одновременного присвоения значения ёмкости из нескольких потоков,
+            # мы сначала пробуем нарастить ёмкость ведра
+            # (результат hincrby нужен сразу, поэтому эта команда не попадает в pipeline)
+            incremented = self._redis.hincrby(self.base_key, self.capacity_key, 1)
+        self._commit(pipeline if pipeline is not None else self._redis, incremented)
 
-        cache_interval = self.rule.interval.total_seconds() * (self.options.periods_to_overtake + 1)
-        cache_interval = max(int(cache_interval), 1)
+    def _commit(self, redis, incremented: [None, int]):
+        """
+        Записывает новое состояние ведра (см. commit_request)
+        :param redis: клиент или pipeline
+        :param incremented: результат наращивания ёмкости ведра, у которого нет даты обновления
+        """
+        cache_interval = self._cache_interval
         updated_at = self._updated_at
-        max_capacity = self.rule.max_requests - 1
-        now = datetime.utcnow()
+        max_capacity = self.rule.max_requests - self.cost
+        now = clock = self.options.clock()
 
         if updated_at is None:
-            # во избежание одновременного присвоения значения ёмкости из нескольких потоков,
-            # мы сначала пробуем нарастить ёмкость ведра
-            self._log('create', self.base_key, 'for', cache_interval, '(%d capacity)' % max_capacity)
-            if self._capacity is None or self._redis.hincrby(self.base_key, self.capacity_key, 1) > max_capacity:
-                self._redis.hset(self.base_key, self.capacity_key, max_capacity)
-                self._redis.expire(self.base_key, cache_interval)
-            self._redis.hset(self.base_key, self.updated_at_key, now.timestamp())
-
-        elif updated_at < now - self.rule.interval:
-            self._log('update', self.base_key, '(+%d)' % max_capacity)
-            self._redis.hmset(self.base_key, {
-                self.capacity_key: (self._capacity or 0) + max_capacity,
-                self.updated_at_key: now.timestamp()
+            capacity = incremented
+            if incremented is None or incremented > max_capacity:
+                capacity = max_capacity
+                redis.hset(self.base_key, self.capacity_key, max_capacity)
+                redis.expire(self.base_key, cache_interval)
+            redis.hset(self.base_key, self.updated_at_key, now)
+            self._event('create', capacity)
+
+        elif updated_at < now - self.rule.seconds:
+            capacity = (self._capacity or 0) + max_capacity
+            redis.hmset(self.base_key, {
+                self.capacity_key: capacity,
+                self.updated_at_key: now
             })
-            self._redis.expire(self.base_key, cache_interval)
+            redis.expire(self.base_key, cache_interval)
+            self._event('refill', capacity)
+        else:
+            capacity = self._capacity - self.cost
+            now = updated_at
+            redis.hincrby(self.base_key, self.capacity_key, -self.cost)
+            self._event('spend', capacity)
+
+        # состояние ведра после записи: следующая проверка того же ведра учитывает этот запрос
+        self.cache_dict = {self.capacity_key: capacity, self.updated_at_key: now}
+        self.remaining = capacity
+        self.reset_after = timedelta(seconds=max(now + self.rule.seconds - clock, 0))
+
+    @staticmethod
+    def _refund_arguments(buckets: list) -> tuple:
+        """Аргументы скрипта REFUND для вёдер зафиксированного запроса"""
+        args = [buckets[0].options.script_now()]
+        for b in buckets:
+            args += [b.rule.algorithm, b.rule.max_requests, b.rule.seconds, b.cost]
+        return [b.base_key for b in buckets], args
+
+
+class ScriptedThrottlingBucket(ThrottlingBucket):
+    """
+    Ведро, которое проверяет лимит и фиксирует запрос за одно атомарное обращение к Redis
+    (скрипт CHECK_AND_COMMIT). Состояние ведра не читается в конструкторе.
+    Правила GCRARule и SlidingWindowRule всегда проверяются такими вёдрами.
+
+    check_throttle() сразу списывает запрос, если лимит не превышен, поэтому последующий
+    commit_request() ничего не делает. Несколько вёдер проверяются совместно через evaluate():
+    если хотя бы одно из них переполнено, запрос не списывается ни с одного.
+    """
+    cache_dict = {}
+    retry_after = None
+    evaluated = False
+
+    def _load(self) -> dict:
+        return {}
+
+    @classmethod
+    def evaluate(cls, buckets: list):
+        """Проверяет вёдра и фиксирует в них запрос одним вызовом скрипта"""
+        buckets = [b for b in buckets if not b.evaluated]
+        if buckets:
+            keys, args = cls._script_arguments(buckets)
+            script = buckets[0].options.script(CHECK_AND_COMMIT)
+            cls._apply_result(buckets, script(keys=keys, args=args))
+
+    @staticmethod
+    def _script_arguments(buckets: list) -> tuple:
+        args = [buckets[0].options.script_now()]
+        for b in buckets:
+            args += [b.rule.algorithm, b.rule.max_requests, b.rule.seconds, b._cache_interval, b.cost]
+        return [b.base_key for b in buckets], args
+
+    @staticmethod
+    def _apply_result(buckets: list, result: list):
+        allowed, *result = result
+        for i, b in enumerate(buckets):
+            remaining, retry_after, reset = result[i * 3:i * 3 + 3]
+            b.evaluated = True
+            b.remaining = int(remaining)
+            b.retry_after = timedelta(milliseconds=int(retry_after)) if retry_after else None
+            b.reset_after = timedelta(milliseconds=int(reset))
+            if b.retry_after:
+                b._remember_throttle(b.retry_after, b.remaining)
+            b.cache_dict = {b.capacity_key: b.remaining}
+            b._report(b.retry_after)
+            if allowed:
+                b._event('spend', b.remaining)
+
+    def check_throttle(self) -> [None, timedelta]:
+        if not self.evaluated:
+            timeout = self.local_throttle()
+            if timeout:
+                return self._report(timeout)
+            self.evaluate([self])
+        return self.retry_after
+
+    def commit_request(self, pipeline=None):
+        if not self.evaluated:
+            self.evaluate([self])
+
+
+class LeasedThrottlingBucket(ThrottlingBucket):
+    """
+    Ведро правила с lease_size. Процесс резервирует в хранилище сразу несколько токенов ведра
+    (скрипт LEASE) и списывает запросы с них без обращения к хранилищу.
+    Аренда действует до пополнения ведра, из которого она получена. Неизрасходованные токены возвращаются в ведро
+    при замене аренды новой и при выходе из процесса.
+
+    Как и у ScriptedThrottlingBucket, check_throttle() сразу списывает запрос, а commit_request() ничего не делает.
+    refund() возвращает токены запроса в аренду, если запрос в итоге не исполняется.
+    """
+    cache_dict = {}
+    retry_after = None
+    evaluated = False
+    taken = False
+    # проверка может запросить новую аренду из хранилища
+    loaded = False
+
+    def _load(self) -> dict:
+        return {}
+
+    def _take(self) -> bool:
+        """Списывает запрос с действующей аренды"""
+        self.taken = self.evaluated = self.options.leases.take(self.base_key, self.cost)
+        if self.taken:
+            self._report(None)
+        return self.taken
+
+    def _lease_arguments(self) -> list:
+        return [self.options.script_now(), self.rule.max_requests, self.rule.seconds,
+                self._cache_interval, max(self.rule.lease_size, self.cost), self.cost]
+
+    def _apply_lease(self, result: list):
+        """Сохраняет полученную аренду, возвращает вытесненную ею"""
+        grant, refill_ms, stamp = result
+        self.evaluated = True
+        if grant:
+            self._event('lease', int(grant))
+            self._report(None)
+            self.taken = True
+            # после пополнения ведра токены аренды уже не вернуть в него, аренда истекает вместе с ним
+            return self.options.leases.put(self.base_key, int(grant) - self.cost, stamp, int(refill_ms) / 1000)
+        self.retry_after = timedelta(milliseconds=int(refill_ms))
+        # ёмкость ведра неизвестна, но она меньше стоимости запроса
+        self._remember_throttle(self.retry_after, self.cost - 1)
+        self._report(self.retry_after)
+
+    def evaluate(self):
+        if self._take():
+            return
+        self._return_lease(self.options.leases.pop(self.base_key))
+        result = self.options.script(LEASE)(keys=[self.base_key], args=self._lease_arguments())
+        self._return_lease(self._apply_lease(result))
+
+    def _return_lease(self, lease):
+        if lease is not None and lease.tokens > 0:
+            self.options.script(RETURN_LEASE)(keys=[self.base_key], args=[lease.stamp, lease.tokens])
+
+    def check_throttle(self) -> [None, timedelta]:
+        if not self.evaluated:
+            timeout = self.local_throttle()
+            if timeout:
+                return self._report(timeout)
+            self.evaluate()
+        return self.retry_after
+
+    def commit_request(self, pipeline=None):
+        if not self.evaluated:
+            self.evaluate()
+
+    def refund(self):
+        if self.taken:
+            self.options.leases.refund(self.base_key, self.cost)
+            self.taken = self.evaluated = False
+
+
+class AsyncThrottlingBucket(ThrottlingBucket):
+    """
+    Асинхронный вариант ThrottlingBucket, работающий через redis.asyncio (ThrottlingOptions.async_redis).
+    Состояние не читается в конструкторе: оно загружается в load() или при первом check_throttle().
+    """
+
+    def __init__(self, rule: ThrottlingRule, arguments_bundle: dict, options: ThrottlingOptions=None, load=False,
+                 arguments_key: str=None, cost: int=1, hash_tag: str=None):
+        super().__init__(rule, arguments_bundle, options, load=False, arguments_key=arguments_key, cost=cost,
+                         hash_tag=hash_tag)
+
+    @property
+    def _redis(self):
+        return self.options.async_redis
+
+    async def load(self):
+        self.set_state(await self._redis.hgetall(self.base_key))
+
+    async def check_throttle(self) -> [None, timedelta]:
+        timeout = self.local_throttle()
+        if timeout:
+            return self._report(timeout)
+        if self.cache_dict is None:
+            await self.load()
+        return super().check_throttle()
+
+    async def commit_request(self, pipeline=None):
+        if self.cache_dict is None:
+            await self.load()
+        incremented = None
+        if self._updated_at is None and self._capacity is not None:
+            incremented = await self._redis.hincrby(self.base_key, self.capacity_key, 1)
+        if pipeline is not None:
+            self._commit(pipeline, incremented)
         else:
-            self._log('spent', self.base_key, '%d remaining', self._capacity - 1)
-            self._redis.hincrby(self.base_key, self.capacity_key, -1)
+            pipe = self._redis.pipeline(self.options.transactions)
+            self._commit(pipe, incremented)
+            await pipe.execute()
+
+
+class AsyncScriptedThrottlingBucket(AsyncThrottlingBucket, ScriptedThrottlingBucket):
+    """Асинхронный вариант ScriptedThrottlingBucket"""
+
+    @classmethod
+    async def evaluate(cls, buckets: list):
+        buckets = [b for b in buckets if not b.evaluated]
+        if buckets:
+            keys, args = cls._script_arguments(buckets)
+            script = buckets[0].options.async_script(CHECK_AND_COMMIT)
+            cls._apply_result(buckets, await script(keys=keys, args=args))
+
+    async def check_throttle(self) -> [None, timedelta]:
+        if not self.evaluated:
+            timeout = self.local_throttle()
+            if timeout:
+                return self._report(timeout)
+            await self.evaluate([self])
+        return self.retry_after
+
+    async def commit_request(self, pipeline=None):
+        if not self.evaluated:
+            await self.evaluate([self])
+
+
+class AsyncLeasedThrottlingBucket(AsyncThrottlingBucket, LeasedThrottlingBucket):
+    """Асинхронный вариант LeasedThrottlingBucket"""
+
+    async def evaluate(self):
+        if self._take():
+            return
+        await self._return_lease(self.options.leases.pop(self.base_key))
+        result = await self.options.async_script(LEASE)(keys=[self.base_key], args=self._lease_arguments())
+        await self._return_lease(self._apply_lease(result))
+
+    async def _return_lease(self, lease):
+        if lease is not None and lease.tokens > 0:
+            await self.options.async_script(RETURN_LEASE)(keys=[self.base_key], args=[lease.stamp, lease.tokens])
+
+    async def check_throttle(self) -> [None, timedelta]:
+        if not self.evaluated:
+            timeout = self.local_throttle()
+            if timeout:
+                return self._report(timeout)
+            await self.evaluate()
+        return self.retry_after
+
+    async def commit_request(self, pipeline=None):
+        if not self.evaluated:
+            await self.evaluate()
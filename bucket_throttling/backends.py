@@ -0,0 +1,593 @@
+"""
+Хранилища состояния вёдер.
+
+Ведро работает с хранилищем через подмножество API StrictRedis (см. BaseBackend),
+поэтому клиент redis подходит в качестве хранилища без обёрток.
+"""
+import hashlib
+import math
+import time
+from bisect import bisect
+from collections import OrderedDict
+from threading import Lock
+
+from .scripts import CHECK_AND_COMMIT, LEASE, RETURN_LEASE, REFUND
+
+
+class BaseBackend:
+    """
+    Интерфейс хранилища вёдер. Ключи - строки, состояние ведра - хэш с полями
+    capacity и updated_at, имеющий время жизни.
+
+    requires_hash_tags - хранилище распределяет ключи по узлам, поэтому ключи вёдер одного набора аргументов
+                         должны содержать общий hash tag (см. ThrottlingOptions.use_hash_tags)
+    """
+    requires_hash_tags = False
+
+    def hgetall(self, key: str) -> dict:
+        raise NotImplementedError
+
+    def hincrby(self, key: str, field: str, amount: int = 1) -> int:
+        raise NotImplementedError
+
+    def hset(self, key: str, field: str, value):
+        raise NotImplementedError
+
+    def hmset(self, key: str, mapping: dict):
+        raise NotImplementedError
+
+    def expire(self, key: str, seconds: int) -> bool:
+        raise NotImplementedError
+
+    def delete(self, *keys) -> int:
+        raise NotImplementedError
+
+    def pipeline(self, transaction=True):
+        """Объект с теми же методами, накапливающий команды до вызова execute()"""
+        raise NotImplementedError
+
+    def register_script(self, script: str):
+        """Вызываемый объект script(keys=[...], args=[...]) (см. scripts.py)"""
+        raise NotImplementedError
+
+    def ping(self) -> bool:
+        """Проверка доступности хранилища (см. breaker.CircuitBreaker)"""
+        return True
+
+    def as_async(self):
+        """Асинхронный интерфейс к хранилищу (см. ThrottlingOptions.async_redis)"""
+        return AsyncBackend(self)
+
+
+class _Record:
+    """
+    Состояние ведра в памяти. Для правил GCRARule в updated_at хранится theoretical arrival time,
+    для SlidingWindowRule в capacity, updated_at и previous - счётчик текущего окна, его номер и счётчик предыдущего.
+    """
+    __slots__ = ('capacity', 'updated_at', 'expires_at', 'previous')
+
+    def __init__(self):
+        self.capacity = None
+        self.updated_at = None
+        self.expires_at = None
+        self.previous = None
+
+
+class _Shard:
+    __slots__ = ('lock', 'records')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.records = OrderedDict()
+
+
+class MemoryBackend(BaseBackend):
+    """
+    Хранилище вёдер в памяти процесса.
+
+    Ключи распределены по shards словарям, у каждого из которых своя блокировка.
+    Время жизни ведра соблюдается так же, как EXPIRE в redis: просроченные записи удаляются при обращении.
+    Если в shard больше max_size / shards записей, удаляются давно не использовавшиеся (LRU).
+    """
+    fields = _Record.__slots__[:2]
+
+    def __init__(self, max_size=1000000, shards=16, clock=time.time):
+        """
+        :param max_size: максимальное кол-во вёдер
+        :param shards: кол-во независимо блокируемых словарей
+        :param clock: функция текущего времени (сек), по которой отсчитывается время жизни вёдер
+        """
+        self.shards = [_Shard() for _ in range(shards)]
+        self.shard_size = max(max_size // shards, 1)
+        self.clock = clock
+
+    def __len__(self):
+        return sum(len(s.records) for s in self.shards)
+
+    def _shard(self, key: str) -> _Shard:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def _get(self, shard: _Shard, key: str, create=False) -> [None, _Record]:
+        """Возвращает запись ведра. Вызывается под блокировкой shard"""
+        record = shard.records.get(key)
+        if record is not None and record.expires_at is not None and record.expires_at <= self.clock():
+            del shard.records[key]
+            record = None
+
+        if record is not None:
+            shard.records.move_to_end(key)
+        elif create:
+            record = self._insert(shard, key, _Record())
+        return record
+
+    def _insert(self, shard: _Shard, key: str, record: _Record) -> _Record:
+        shard.records[key] = record
+        if len(shard.records) > self.shard_size:
+            shard.records.popitem(last=False)
+        return record
+
+    def hgetall(self, key: str) -> dict:
+        shard = self._shard(key)
+        with shard.lock:
+            record = self._get(shard, key)
+            if record is None:
+                return {}
+            ret = {}
+            for field in self.fields:
+                value = getattr(record, field)
+                if value is not None:
+                    ret[field.encode()] = value
+            return ret
+
+    def hincrby(self, key: str, field: str, amount: int = 1) -> int:
+        shard = self._shard(key)
+        with shard.lock:
+            record = self._get(shard, key, create=True)
+            value = int(getattr(record, field) or 0) + amount
+            setattr(record, field, value)
+            return value
+
+    def hset(self, key: str, field: str, value):
+        self.hmset(key, {field: value})
+
+    def hmset(self, key: str, mapping: dict):
+        shard = self._shard(key)
+        with shard.lock:
+            record = self._get(shard, key, create=True)
+            for field, value in mapping.items():
+                setattr(record, field, value)
+        return True
+
+    def expire(self, key: str, seconds: int) -> bool:
+        shard = self._shard(key)
+        with shard.lock:
+            record = self._get(shard, key)
+            if record is None:
+                return False
+            record.expires_at = self.clock() + seconds
+            return True
+
+    def delete(self, *keys) -> int:
+        ret = 0
+        for key in keys:
+            shard = self._shard(key)
+            with shard.lock:
+                ret += shard.records.pop(key, None) is not None
+        return ret
+
+    def purge(self) -> int:
+        """Удаляет просроченные вёдра, возвращает их кол-во"""
+        ret = 0
+        now = self.clock()
+        for shard in self.shards:
+            with shard.lock:
+                expired = [k for k, v in shard.records.items() if v.expires_at is not None and v.expires_at <= now]
+                for key in expired:
+                    del shard.records[key]
+                ret += len(expired)
+        return ret
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def register_script(self, script: str):
+        """Скрипты из scripts.py реализованы на python и исполняются под блокировкой затронутых shards"""
+        scripts = {
+            CHECK_AND_COMMIT: self._check_and_commit,
+            LEASE: self._lease,
+            RETURN_LEASE: self._return_lease,
+            REFUND: self._refund,
+        }
+        if script not in scripts:
+            raise NotImplementedError('MemoryBackend supports only scripts from bucket_throttling.scripts')
+        method = scripts[script]
+
+        def call(keys=(), args=(), client=None):
+            if client is not None:
+                # вызов в pipeline (как у redis-py): скрипт исполнится по execute()
+                client.stack.append((call, (keys, args), {}))
+                return client
+            shards = sorted({id(s): s for s in map(self._shard, keys)}.values(), key=self.shards.index)
+            for shard in shards:
+                shard.lock.acquire()
+            try:
+                return method(keys, args)
+            finally:
+                for shard in shards:
+                    shard.lock.release()
+        return call
+
+    def _check_and_commit(self, keys, args) -> list:
+        """Реализация скрипта CHECK_AND_COMMIT"""
+        now = float(args[0]) if args[0] else self.clock()
+        rules = []
+        for i, key in enumerate(keys):
+            algorithm, max_requests, interval, cache_interval, cost = args[i * 5 + 1:i * 5 + 6]
+            max_requests, interval, cost = int(max_requests), float(interval), int(cost)
+            check, commit = self.algorithms[algorithm]
+            record = self._get(self._shard(key), key)
+            # новая запись сохраняется, только если запрос будет зафиксирован
+            created = record is None
+            record = record or _Record()
+            retry = check(self, record, now, max_requests, interval, cost)
+            if cost > max_requests:
+                # стоимость запроса больше, чем ведро может вместить
+                retry = interval
+            retry = math.ceil(retry * 1000) if retry > 0 else 0
+            rules.append((key, created, commit, record, max_requests, interval, int(cache_interval), cost, retry))
+        allowed = int(not any(r[-1] for r in rules))
+
+        ret = [allowed]
+        for key, created, commit, record, max_requests, interval, cache_interval, cost, retry in rules:
+            if allowed and created:
+                self._insert(self._shard(key), key, record)
+            remaining, reset = commit(self, record, now, max_requests, interval, cache_interval, cost, allowed)
+            ret += [remaining, retry, math.ceil(reset * 1000) if reset > 0 else 0]
+        return ret
+
+    def _check_bucket(self, record: _Record, now: float, max_requests: int, interval: float, cost: int) -> float:
+        if record.updated_at is None:
+            return 0
+        if float(record.updated_at) + interval > now:
+            if int(record.capacity or 0) < cost:
+                return float(record.updated_at) + interval - now
+        elif int(record.capacity or 0) + max_requests < cost:
+            return interval
+        return 0
+
+    def _commit_bucket(self, record: _Record, now: float, max_requests: int, interval: float,
+                       cache_interval: int, cost: int, allowed: bool) -> int:
+        if allowed:
+            if record.updated_at is None:
+                record.capacity = max_requests - cost
+                record.updated_at = now
+                record.expires_at = self.clock() + cache_interval
+            elif float(record.updated_at) < now - interval:
+                record.capacity = int(record.capacity or 0) + max_requests - cost
+                record.updated_at = now
+                record.expires_at = self.clock() + cache_interval
+            else:
+                record.capacity = int(record.capacity or 0) - cost
+        reset = float(record.updated_at) + interval - now if record.updated_at is not None else 0
+        return int(record.capacity or 0), reset
+
+    def _check_gcra(self, record: _Record, now: float, max_requests: int, interval: float, cost: int) -> float:
+        record.updated_at = max(record.updated_at or now, now)
+        return record.updated_at + interval / max_requests * cost - interval - now
+
+    def _commit_gcra(self, record: _Record, now: float, max_requests: int, interval: float,
+                     cache_interval: int, cost: int, allowed: bool) -> int:
+        emission = interval / max_requests
+        if allowed:
+            record.updated_at += emission * cost
+            record.expires_at = self.clock() + record.updated_at - now
+        remaining = max(math.floor((interval - (record.updated_at - now)) / emission + 1e-6), 0)
+        return remaining, record.updated_at - now
+
+    def _check_window(self, record: _Record, now: float, max_requests: int, interval: float, cost: int) -> float:
+        window = math.floor(now / interval)
+        if record.updated_at == window - 1:
+            record.previous, record.capacity = record.capacity, 0
+        elif record.updated_at != window:
+            record.previous, record.capacity = 0, 0
+        record.updated_at = window
+        current, previous = record.capacity, record.previous
+        elapsed = now - window * interval
+        limit = max_requests - cost
+        if limit < 0:
+            # стоимость запроса больше окна: время ожидания задаёт _check_and_commit
+            return interval
+        if previous * (1 - elapsed / interval) + current > limit:
+            if current > limit:
+                return interval - elapsed + interval * (1 - limit / current)
+            return interval * (1 - (limit - current) / previous) - elapsed
+        return 0
+
+    def _commit_window(self, record: _Record, now: float, max_requests: int, interval: float,
+                       cache_interval: int, cost: int, allowed: bool) -> int:
+        if allowed:
+            record.capacity += cost
+            record.expires_at = self.clock() + math.ceil(interval * 2)
+        elapsed = now - record.updated_at * interval
+        remaining = max_requests - record.previous * (1 - elapsed / interval) - record.capacity
+        return max(math.floor(remaining + 1e-6), 0), interval - elapsed
+
+    algorithms = {
+        'bucket': (_check_bucket, _commit_bucket),
+        'gcra': (_check_gcra, _commit_gcra),
+        'window': (_check_window, _commit_window),
+    }
+
+    def _lease(self, keys, args) -> list:
+        """Реализация скрипта LEASE"""
+        key = keys[0]
+        max_requests, interval, cache_interval, lease_size, min_grant = map(float, args[1:6])
+        now = float(args[0]) if args[0] else self.clock()
+        record = self._get(self._shard(key), key) or _Record()
+        available = int(record.capacity or 0)
+        updated_at = record.updated_at
+        if updated_at is None:
+            available = int(max_requests)
+            updated_at = now
+        elif float(updated_at) < now - interval:
+            available += int(max_requests)
+            updated_at = now
+        refill = math.ceil((float(updated_at) + interval - now) * 1000)
+
+        grant = min(int(lease_size), available)
+        if grant < min_grant:
+            # если ведро только что пополнено, не хватает даже полного ведра
+            return [0, refill, updated_at]
+        if updated_at != record.updated_at:
+            record = self._insert(self._shard(key), key, record)
+            record.updated_at = updated_at
+            record.expires_at = self.clock() + cache_interval
+        record.capacity = available - grant
+        return [grant, refill, record.updated_at]
+
+    def _refund(self, keys, args) -> int:
+        """Реализация скрипта REFUND"""
+        now = float(args[0]) if args[0] else self.clock()
+        for i, key in enumerate(keys):
+            algorithm, max_requests, interval, cost = args[i * 4 + 1:i * 4 + 5]
+            interval, cost = float(interval), int(cost)
+            record = self._get(self._shard(key), key)
+            if record is None:
+                continue
+            if algorithm == 'gcra':
+                record.updated_at -= interval / int(max_requests) * cost
+                record.expires_at = self.clock() + record.updated_at - now
+            elif algorithm == 'window':
+                if record.updated_at >= math.floor(now / interval) - 1:
+                    record.capacity = max(record.capacity - cost, 0)
+            elif record.updated_at is not None:
+                record.capacity = int(record.capacity or 0) + cost
+        return len(keys)
+
+    def _return_lease(self, keys, args) -> [None, int]:
+        """Реализация скрипта RETURN_LEASE"""
+        record = self._get(self._shard(keys[0]), keys[0])
+        if record is None or record.updated_at != args[0]:
+            return None
+        record.capacity = int(record.capacity or 0) + int(args[1])
+        return record.capacity
+
+
+class MemoryPipeline:
+    """Накапливает команды MemoryBackend и исполняет их по execute()"""
+    commands = ('hgetall', 'hincrby', 'hset', 'hmset', 'expire', 'delete')
+
+    def __init__(self, backend: MemoryBackend):
+        self.backend = backend
+        self.stack = []
+
+    def __len__(self):
+        return len(self.stack)
+
+    def __getattr__(self, name):
+        if name not in self.commands:
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            self.stack.append((getattr(self.backend, name), args, kwargs))
+            return self
+        return command
+
+    def execute(self) -> list:
+        stack, self.stack = self.stack, []
+        return [method(*args, **kwargs) for (method, args, kwargs) in stack]
+
+
+class AsyncBackend:
+    """
+    Асинхронный интерфейс к синхронному хранилищу, которое не выполняет блокирующего I/O
+    (например, MemoryBackend). Используется ThrottlingOptions.async_redis.
+    """
+
+    def __init__(self, backend: BaseBackend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+
+        async def command(*args, **kwargs):
+            return method(*args, **kwargs)
+        return command
+
+    def pipeline(self, transaction=True):
+        return AsyncPipeline(self.backend.pipeline(transaction))
+
+    def register_script(self, script: str):
+        script = self.backend.register_script(script)
+
+        async def call(keys=(), args=()):
+            return script(keys=keys, args=args)
+        return call
+
+
+class AsyncPipeline:
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def __len__(self):
+        return len(self.pipeline)
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+    async def execute(self) -> list:
+        return self.pipeline.execute()
+
+
+def hash_tag(key: str) -> str:
+    """
+    Часть ключа, по которой Redis Cluster выбирает слот
+
+    >>> hash_tag('THROTTLING:{user;1}requests;5')
+    'user;1'
+    """
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+class ShardedBackend(BaseBackend):
+    """
+    Распределяет вёдра по нескольким независимым узлам redis с помощью консистентного хэширования.
+    Узел выбирается по hash tag ключа, поэтому все вёдра одного набора аргументов хранятся на одном узле,
+    и скрипты, проверяющие их вместе, остаются атомарными.
+    """
+    requires_hash_tags = True
+    commands = ('hgetall', 'hincrby', 'hset', 'hmset', 'expire', 'delete')
+
+    def __init__(self, nodes: list = None, clients: list = None, replicas=100):
+        """
+        :param nodes: список словарей настроек для конструктора StrictRedis
+        :param clients: список готовых клиентов (или других хранилищ) вместо nodes
+        :param replicas: кол-во точек каждого узла на кольце хэшей
+        """
+        if clients is None:
+            import redis
+            clients = [redis.StrictRedis(**node) for node in nodes]
+        self.nodes = nodes
+        self.clients = clients
+        self.replicas = replicas
+        ring = sorted((self._hash('%d:%d' % (i, r)), i) for i in range(len(clients)) for r in range(replicas))
+        self.ring_hashes = [h for h, _ in ring]
+        self.ring_nodes = [i for _, i in ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+    def node_index(self, key: str) -> int:
+        i = bisect(self.ring_hashes, self._hash(hash_tag(key)))
+        return self.ring_nodes[i % len(self.ring_nodes)]
+
+    def client(self, key: str):
+        return self.clients[self.node_index(key)]
+
+    def hgetall(self, key: str) -> dict:
+        return self.client(key).hgetall(key)
+
+    def hincrby(self, key: str, field: str, amount: int = 1) -> int:
+        return self.client(key).hincrby(key, field, amount)
+
+    def hset(self, key: str, field: str, value):
+        return self.client(key).hset(key, field, value)
+
+    def hmset(self, key: str, mapping: dict):
+        return self.client(key).hmset(key, mapping)
+
+    def expire(self, key: str, seconds: int) -> bool:
+        return self.client(key).expire(key, seconds)
+
+    def delete(self, *keys) -> int:
+        return sum(self.client(key).delete(key) for key in keys)
+
+    def ping(self) -> bool:
+        return all(client.ping() for client in self.clients)
+
+    def pipeline(self, transaction=True):
+        return ShardedPipeline(self, transaction)
+
+    def register_script(self, script: str):
+        scripts = [client.register_script(script) for client in self.clients]
+
+        def call(keys=(), args=(), client=None):
+            i = self.node_index(keys[0])
+            if client is not None:
+                return client.script(scripts[i], i, keys, args)
+            return scripts[i](keys=keys, args=args)
+        return call
+
+    def as_async(self):
+        if self.nodes is None:
+            raise NotImplementedError('ShardedBackend created with clients can not create async clients')
+        from redis import asyncio as aioredis
+        return AsyncShardedBackend(clients=[aioredis.StrictRedis(**node) for node in self.nodes],
+                                   replicas=self.replicas)
+
+
+class ShardedPipeline:
+    """Распределяет команды по pipeline узлов, execute() возвращает результаты в исходном порядке"""
+
+    def __init__(self, backend: ShardedBackend, transaction=True):
+        self.backend = backend
+        self.transaction = transaction
+        self.pipelines = {}
+        self.order = []
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getattr__(self, name):
+        if name not in self.backend.commands:
+            raise AttributeError(name)
+
+        def command(key, *args, **kwargs):
+            i = self.backend.node_index(key)
+            getattr(self._pipeline(i), name)(key, *args, **kwargs)
+            self.order.append(i)
+            return self
+        return command
+
+    def _pipeline(self, i: int):
+        if i not in self.pipelines:
+            self.pipelines[i] = self.backend.clients[i].pipeline(self.transaction)
+        return self.pipelines[i]
+
+    def script(self, script, i: int, keys, args):
+        """Добавляет вызов скрипта узла i (см. ShardedBackend.register_script)"""
+        script(keys=keys, args=args, client=self._pipeline(i))
+        self.order.append(i)
+        return self
+
+    def _collect(self, results: dict) -> list:
+        results = {i: iter(r) for i, r in results.items()}
+        return [next(results[i]) for i in self.order]
+
+    def execute(self) -> list:
+        return self._collect({i: p.execute() for i, p in self.pipelines.items()})
+
+
+class AsyncShardedBackend(ShardedBackend):
+    """ShardedBackend для клиентов redis.asyncio"""
+
+    async def delete(self, *keys) -> int:
+        return sum([await self.client(key).delete(key) for key in keys])
+
+    def pipeline(self, transaction=True):
+        return AsyncShardedPipeline(self, transaction)
+
+    def as_async(self):
+        return self
+
+
+class AsyncShardedPipeline(ShardedPipeline):
+
+    async def execute(self) -> list:
+        return self._collect({i: await p.execute() for i, p in self.pipelines.items()})
@@ -0,0 +1,267 @@
+"""
+Деградация при недоступности хранилища (ThrottlingOptions.breaker).
+
+Пока хранилище отвечает, обращения к нему проходят без изменений. После failure_threshold ошибок подряд
+CircuitBreaker размыкается: все обращения направляются в запасное хранилище (fallback), а фоновый поток
+раз в probe_interval секунд проверяет основное хранилище и замыкает CircuitBreaker, как только оно ответит.
+Запросы при этом не ждут недоступное хранилище.
+"""
+import logging
+import time
+from functools import partial
+from threading import Lock, Thread
+
+from redis import RedisError
+
+from .backends import BaseBackend, MemoryBackend, MemoryPipeline
+from .scripts import CHECK_AND_COMMIT, LEASE, RETURN_LEASE, REFUND
+
+logger = logging.getLogger('bucket_throttling')
+
+
+class _PolicyBackend(BaseBackend):
+    """Хранилище без состояния, результат проверки вёдер в котором определён политикой"""
+
+    def hincrby(self, key: str, field: str, amount: int = 1) -> int:
+        return 0
+
+    def hset(self, key: str, field: str, value):
+        return 0
+
+    def hmset(self, key: str, mapping: dict):
+        return True
+
+    def expire(self, key: str, seconds: int) -> bool:
+        return True
+
+    def delete(self, *keys) -> int:
+        return 0
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def register_script(self, script: str):
+        methods = {CHECK_AND_COMMIT: self._check_and_commit, LEASE: self._lease, RETURN_LEASE: self._return_lease,
+                   REFUND: self._refund}
+        method = methods[script]
+
+        def call(keys=(), args=(), client=None):
+            if client is not None:
+                client.stack.append((method, (keys, args), {}))
+                return client
+            return method(keys, args)
+        return call
+
+    def _return_lease(self, keys, args):
+        return None
+
+    def _refund(self, keys, args) -> int:
+        return 0
+
+
+class FailOpenBackend(_PolicyBackend):
+    """Пропускает все запросы"""
+
+    def hgetall(self, key: str) -> dict:
+        return {}
+
+    def _check_and_commit(self, keys, args) -> list:
+        ret = [1]
+        for i in range(len(keys)):
+            ret += [int(args[i * 5 + 2]) - int(args[i * 5 + 5]), 0, 0]
+        return ret
+
+    def _lease(self, keys, args) -> list:
+        return [int(args[4]), int(float(args[2]) * 1000), args[0]]
+
+
+class FailClosedBackend(_PolicyBackend):
+    """Отклоняет все запросы на интервал правила"""
+
+    def hgetall(self, key: str) -> dict:
+        return {b'capacity': b'0', b'updated_at': repr(time.time()).encode()}
+
+    def _check_and_commit(self, keys, args) -> list:
+        ret = [0]
+        for i in range(len(keys)):
+            interval_ms = int(float(args[i * 5 + 3]) * 1000)
+            ret += [0, interval_ms, interval_ms]
+        return ret
+
+    def _lease(self, keys, args) -> list:
+        return [0, int(float(args[2]) * 1000), args[0]]
+
+
+FALLBACKS = {
+    'open': FailOpenBackend,
+    'closed': FailClosedBackend,
+    'local': MemoryBackend,
+}
+
+
+class CircuitBreaker:
+    """
+    Счётчик ошибок хранилища. Общий для синхронного и асинхронного клиентов ThrottlingOptions.
+    """
+
+    def __init__(self, fallback: [str, BaseBackend]='open', failure_threshold=3, probe_interval=1.0,
+                 errors=(RedisError, OSError)):
+        """
+        :param fallback: запасное хранилище, пока основное недоступно:
+                         open - пропускать все запросы, closed - отклонять все запросы,
+                         local - ограничивать запросы в памяти процесса (MemoryBackend), либо экземпляр хранилища
+        :param failure_threshold: кол-во ошибок подряд, после которого CircuitBreaker размыкается
+        :param probe_interval: интервал проверки основного хранилища (сек)
+        :param errors: исключения, считающиеся ошибками хранилища
+        """
+        self.fallback = FALLBACKS[fallback]() if isinstance(fallback, str) else fallback
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.errors = errors
+        self.lock = Lock()
+        self.failures = 0
+        self.tripped = False
+
+    def success(self):
+        if self.failures:
+            self.failures = 0
+
+    def failure(self, probe):
+        """
+        Учитывает ошибку хранилища
+        :param probe: функция проверки основного хранилища, исполняемая в фоне
+        """
+        with self.lock:
+            self.failures += 1
+            if self.tripped or self.failures < self.failure_threshold:
+                return
+            self.tripped = True
+        logger.warning('throttling storage is unavailable, using %s', self.fallback.__class__.__name__)
+        Thread(target=self._probe, args=(probe,), daemon=True).start()
+
+    def _probe(self, probe):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                probe()
+            except self.errors:
+                continue
+            with self.lock:
+                self.failures = 0
+                self.tripped = False
+            logger.warning('throttling storage is available again')
+            return
+
+
+class GuardedStorage:
+    """Обёртка хранилища, переключающая обращения на CircuitBreaker.fallback при ошибках"""
+
+    def __init__(self, storage, breaker: CircuitBreaker, probe):
+        self.storage = storage
+        self.breaker = breaker
+        self.probe = probe
+        self.fallback = breaker.fallback
+        self.scripts = {}
+
+    def _call(self, primary, fallback, *args, **kwargs):
+        if not self.breaker.tripped:
+            try:
+                ret = primary(*args, **kwargs)
+            except self.breaker.errors:
+                self.breaker.failure(self.probe)
+            else:
+                self.breaker.success()
+                return ret
+        return fallback(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return partial(self._call, getattr(self.storage, name), getattr(self.fallback, name))
+
+    def pipeline(self, transaction=True):
+        return GuardedPipeline(self, transaction)
+
+    def _script(self, source: str) -> tuple:
+        """Скрипт, зарегистрированный в основном и запасном хранилищах"""
+        if source not in self.scripts:
+            self.scripts[source] = (self.storage.register_script(source), self.fallback.register_script(source))
+        return self.scripts[source]
+
+    def register_script(self, script: str):
+        primary, fallback = self._script(script)
+
+        def call(keys=(), args=(), client=None):
+            if client is not None:
+                return client.script(script, keys, args)
+            return self._call(primary, fallback, keys=keys, args=args)
+        return call
+
+
+class GuardedPipeline:
+    """
+    Накапливает команды и исполняет их в pipeline основного хранилища по execute(),
+    а при ошибке (или разомкнутом CircuitBreaker) - в pipeline запасного хранилища
+    """
+
+    def __init__(self, guarded: GuardedStorage, transaction=True):
+        self.guarded = guarded
+        self.transaction = transaction
+        self.stack = []
+
+    def __len__(self):
+        return len(self.stack)
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.stack.append((name, args, kwargs))
+            return self
+        return command
+
+    def script(self, source: str, keys, args):
+        self.stack.append((None, (source, keys, args), {}))
+        return self
+
+    def _pipeline(self, storage, i: int):
+        """Pipeline хранилища storage с накопленными командами (i - индекс скрипта в GuardedStorage.scripts)"""
+        pipe = storage.pipeline(self.transaction)
+        for name, args, kwargs in self.stack:
+            if name is None:
+                source, keys, script_args = args
+                self.guarded._script(source)[i](keys=keys, args=script_args, client=pipe)
+            else:
+                getattr(pipe, name)(*args, **kwargs)
+        return pipe
+
+    def _execute(self, storage, i: int) -> list:
+        return self._pipeline(storage, i).execute()
+
+    def execute(self) -> list:
+        return self.guarded._call(partial(self._execute, self.guarded.storage, 0),
+                                  partial(self._execute, self.guarded.fallback, 1))
+
+
+class AsyncGuardedStorage(GuardedStorage):
+    """GuardedStorage для асинхронного хранилища (ThrottlingOptions.async_redis)"""
+
+    def __init__(self, storage, breaker: CircuitBreaker, probe):
+        super().__init__(storage, breaker, probe)
+        self.fallback = breaker.fallback.as_async()
+
+    async def _call(self, primary, fallback, *args, **kwargs):
+        if not self.breaker.tripped:
+            try:
+                ret = await primary(*args, **kwargs)
+            except self.breaker.errors:
+                self.breaker.failure(self.probe)
+            else:
+                self.breaker.success()
+                return ret
+        return await fallback(*args, **kwargs)
+
+    def pipeline(self, transaction=True):
+        return AsyncGuardedPipeline(self, transaction)
+
+
+class AsyncGuardedPipeline(GuardedPipeline):
+
+    async def _execute(self, storage, i: int) -> list:
+        return await self._pipeline(storage, i).execute()
@@ -0,0 +1,42 @@
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from threading import Lock
+
+
+class ThrottledCache:
+    """
+    Локальный (в памяти процесса) кэш переполненных вёдер: ключ ведра -> момент, до которого оно переполнено.
+    Пока ведро в кэше, запросы отклоняются без обращения к хранилищу.
+    Размер кэша ограничен max_size, при переполнении удаляются самые старые записи.
+    """
+
+    def __init__(self, max_size=10000, clock=time.monotonic):
+        self.max_size = max_size
+        self.clock = clock
+        self.lock = Lock()
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key: str) -> [None, timedelta]:
+        """Возвращает интервал, через который ведро освободится, или None"""
+        until = self.items.get(key)
+        if until is None:
+            return None
+        now = self.clock()
+        if until > now:
+            return timedelta(seconds=until - now)
+        with self.lock:
+            if self.items.get(key) == until:
+                del self.items[key]
+        return None
+
+    def set(self, key: str, timeout: timedelta):
+        until = self.clock() + timeout.total_seconds()
+        with self.lock:
+            self.items[key] = until
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
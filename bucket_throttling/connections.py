@@ -0,0 +1,40 @@
+"""
+Общие клиенты redis для ThrottlingOptions.
+
+Клиент (а с ним и пул соединений) создаётся один раз для каждого набора настроек подключения
+и разделяется всеми ThrottlingOptions с такими настройками.
+После fork() дочерний процесс не использует клиентов и сокетов родителя: реестр очищается,
+а ThrottlingOptions пересоздают клиентов при следующем обращении (см. generation).
+"""
+import os
+from threading import Lock
+
+# поколение процесса: увеличивается в дочернем процессе после fork()
+generation = 0
+
+_clients = {}
+_lock = Lock()
+
+
+def get_client(key: tuple, factory):
+    """Общий клиент для настроек key, создаётся вызовом factory() при первом обращении"""
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = factory()
+    return client
+
+
+def _after_fork():
+    global generation, _lock
+    generation += 1
+    # сокеты родителя не закрываются: redis-py закрывает соединения только в создавшем их процессе
+    _clients.clear()
+    # блокировка могла удерживаться другим потоком родителя в момент fork()
+    _lock = Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
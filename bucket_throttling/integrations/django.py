@@ -1,41 +1,115 @@
+import asyncio
+import json
+import math
+from functools import lru_cache
 from typing import Callable
 
+from asgiref.sync import sync_to_async
 from django.http.response import JsonResponse
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import get_language, ugettext_lazy as _
 
 from ..translation import localize_timedelta
 from ..utils import *
 
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    from asyncio import iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
 
 class BucketThrottlingMiddleware:
+    """
+    Middleware поддерживает синхронный и асинхронный (ASGI, Django>=3.1) режимы.
+    В асинхронном режиме вёдра проверяются через redis.asyncio, не блокируя event loop.
+    Токены запроса списываются до вызова view, а ответ дополняется заголовками X-RateLimit-*
+    (см. utils.rate_limit_headers).
+    """
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, get_response):
         self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            self.process_view = self.process_view_async
 
     def __call__(self, request):
-        return self.get_response(request)
+        if self.async_mode:
+            # в асинхронном режиме возвращается корутина, которую дождётся обработчик Django
+            return self._acall(request)
+        return add_rate_limit_headers(self.get_response(request), getattr(request, 'throttling_group', None))
+
+    async def _acall(self, request):
+        response = await self.get_response(request)
+        return add_rate_limit_headers(response, getattr(request, 'throttling_group', None))
+
+    default_key_template = KeyTemplate('user', 'method', 'view')
+    # класс ответа на отклонённый запрос, по умолчанию HttpResponseThrottled
+    response_class = None
 
     @classmethod
     def process_view(cls, request, view_func, view_args, view_kwargs):
         if hasattr(view_func, 'throttling_rules'):
-            rules = view_func.throttling_rules
-            arguments_func = view_func.throttling_arguments_func
-            options = view_func.throttling_options
-
-            if isinstance(rules, ThrottlingRule):
-                rules = [rules]
-            if not arguments_func:
-                arguments_func = cls.get_throttling_arguments
-
+            rules, arguments_func, options = cls._get_view_throttling(view_func)
             arguments = arguments_func(request, view_func, view_args, view_kwargs)
-            buckets = get_buckets(rules, arguments, options)
-            timeout = check_throttle(buckets)
+            cost = cls._get_view_cost(view_func)
+            if callable(cost):
+                cost = cost(request, view_func, view_args, view_kwargs)
+            request.throttling_group = BucketGroup(rules, arguments, options, cls._get_key_template(view_func), cost,
+                                                   get_request_buckets(request))
+            timeout = request.throttling_group.acquire()
+
+            if timeout:
+                return cls._throttled_response(timeout, request.throttling_group)
 
-            if not timeout:
-                commit_request(buckets)
-                return
+    @classmethod
+    async def process_view_async(cls, request, view_func, view_args, view_kwargs):
+        if hasattr(view_func, 'throttling_rules'):
+            rules, arguments_func, options = cls._get_view_throttling(view_func)
+            if iscoroutinefunction(arguments_func):
+                arguments = await arguments_func(request, view_func, view_args, view_kwargs)
             else:
-                return HttpResponseThrottled(timeout)
+                # функция аргументов может обращаться к БД (например, request.user)
+                arguments = await sync_to_async(arguments_func)(request, view_func, view_args, view_kwargs)
+            cost = cls._get_view_cost(view_func)
+            if iscoroutinefunction(cost):
+                cost = await cost(request, view_func, view_args, view_kwargs)
+            elif callable(cost):
+                cost = await sync_to_async(cost)(request, view_func, view_args, view_kwargs)
+            request.throttling_group = AsyncBucketGroup(rules, arguments, options, cls._get_key_template(view_func),
+                                                        cost, get_request_buckets(request))
+            timeout = await request.throttling_group.acquire()
+
+            if timeout:
+                return cls._throttled_response(timeout, request.throttling_group)
+
+    @classmethod
+    def _get_view_throttling(cls, view_func) -> tuple:
+        rules = view_func.throttling_rules
+        arguments_func = view_func.throttling_arguments_func or cls.get_throttling_arguments
+        if isinstance(rules, ThrottlingRule):
+            rules = [rules]
+        return rules, arguments_func, view_func.throttling_options
+
+    @classmethod
+    def _throttled_response(cls, timeout: timedelta, group: BucketGroup):
+        return (cls.response_class or HttpResponseThrottled)(timeout, group.rate_limit_headers())
+
+    @staticmethod
+    def _get_view_cost(view_func) -> [int, Callable]:
+        return getattr(view_func, 'throttling_cost', 1)
+
+    @classmethod
+    def _get_key_template(cls, view_func) -> [None, KeyTemplate]:
+        """Для аргументов по умолчанию имена известны заранее"""
+        if not view_func.throttling_arguments_func and \
+                cls.get_throttling_arguments is BucketThrottlingMiddleware.get_throttling_arguments:
+            return cls.default_key_template
 
     @staticmethod
     def get_throttling_arguments(request, view_func, view_args, view_kwargs):
@@ -47,38 +121,108 @@ class BucketThrottlingMiddleware:
         }
 
 
+def get_request_buckets(request) -> dict:
+    """
+    Вёдра, уже списанные в рамках запроса (см. BucketGroup.request_buckets): общие для middleware
+    и ThrottledViewSetMixIn, поэтому ведро с тем же ключом не проверяется и не списывается дважды
+    """
+    request = getattr(request, '_request', request)
+    if not hasattr(request, 'throttling_buckets'):
+        request.throttling_buckets = {}
+    return request.throttling_buckets
+
+
 def throttle_request(throttling_rules: [RuleList, ThrottlingRule],
                      throttling_arguments_func: Callable=None,
-                     throttling_options: ThrottlingOptions=None) -> Callable:
+                     throttling_options: ThrottlingOptions=None,
+                     throttling_cost: [int, Callable]=1) -> Callable:
     """
     Декоратор для view-функций, подлежащих тротлингу.
     :param throttling_rules: Один экземпляр ThrottlingRule или список
     :param throttling_arguments_func: Функция, от которой вычисляется набор аргументов для корзины.
                                       Если не задана, берётся ф-ия по умолчанию.
     :param throttling_options: Экземпляр ThrottlingOptions, если нужны кастомные настройки.
+    :param throttling_cost: Кол-во токенов, списываемых запросом, или функция, вычисляющая его
+                            с теми же аргументами, что и throttling_arguments_func.
     """
     def decorator(func):
         func.throttling_rules = throttling_rules
         func.throttling_arguments_func = throttling_arguments_func
         func.throttling_options = throttling_options
+        func.throttling_cost = throttling_cost
         return func
     return decorator
 
 
+def add_rate_limit_headers(response, group: [None, BucketGroup]):
+    """Дополняет ответ заголовками состояния лимита проверенного запроса, не заменяя уже заданные"""
+    if group is not None and group.timeout is not None:
+        for header, value in group.rate_limit_headers().items():
+            response.setdefault(header, value)
+    return response
+
+
+def round_interval(interval: timedelta) -> int:
+    """
+    Интервал ожидания в миллисекундах, как он отображается в ответе: без необходимости не отображаем
+    микросекунды, а интервал от секунды - и миллисекунды. Округляем вверх, чтобы не обещать повтор раньше срока
+
+    >>> round_interval(timedelta(seconds=47, microseconds=1))
+    48000
+    """
+    ret = -(-interval // timedelta(milliseconds=1))
+    return -(-ret // 1000) * 1000 if ret >= 1000 else ret
+
+
+def retry_after(interval: timedelta) -> int:
+    """Значение Retry-After (сек), согласованное с текстом ответа (см. round_interval)"""
+    return math.ceil(round_interval(interval) / 1000)
+
+
+@lru_cache(maxsize=1024)
+def _render_detail(response_class, language: str, milliseconds: [None, int]) -> tuple:
+    """
+    Текст и JSON-тело ответа на отклонённый запрос (см. HttpResponseThrottled.render_detail).
+    Текст переводится на активный язык, поэтому язык входит в ключ кэша.
+    """
+    if milliseconds is None:
+        detail = str(response_class.default_detail)
+    else:
+        detail = str(response_class.extra_detail % localize_timedelta(timedelta(milliseconds=milliseconds)))
+    return detail, json.dumps({'detail': detail}).encode()
+
+
 class HttpResponseThrottled(JsonResponse):
     status_code = 429
     default_detail = _('Request throttled.')
     extra_detail = _('Expected available in %s.')
+    # тело ответа {"retry_after": <секунды>} вместо текста
+    machine_readable = False
+
+    def __init__(self, interval=None, headers: dict=None):
+        """
+        :param interval: интервал ожидания (timedelta или строка)
+        :param headers: дополнительные заголовки, например BucketGroup.rate_limit_headers()
+        """
+        # тело уже сериализовано, поэтому JsonResponse.__init__ не вызывается
+        super(JsonResponse, self).__init__(self.render_detail(interval)[1], content_type='application/json')
+        if isinstance(interval, timedelta) and interval:
+            self['Retry-After'] = str(retry_after(interval))
+        for header, value in (headers or {}).items():
+            self[header] = value
 
-    def __init__(self, interval=None):
+    @classmethod
+    def render_detail(cls, interval=None) -> tuple:
+        """
+        Возвращает detail ответа и JSON-тело с ним. Для timedelta результат кэшируется
+        по языку и интервалу, округлённому как в round_interval()
+        """
+        if cls.machine_readable and isinstance(interval, timedelta):
+            detail = {'retry_after': retry_after(interval)}
+            return detail, json.dumps(detail).encode()
         if not interval:
-            content = self.default_detail
-        elif isinstance(interval, timedelta):
-            # без необходимости не отображаем микросекунды
-            if int(interval.total_seconds()) > 0 and interval.microseconds > 0:
-                interval -= timedelta(microseconds=interval.microseconds)
-            content = self.extra_detail % localize_timedelta(interval)
-        else:
-            content = self.extra_detail % str(interval)
-
-        super().__init__({'detail': content})
+            return _render_detail(cls, get_language(), None)
+        if isinstance(interval, timedelta):
+            return _render_detail(cls, get_language(), round_interval(interval))
+        detail = str(cls.extra_detail % str(interval))
+        return detail, json.dumps({'detail': detail}).encode()
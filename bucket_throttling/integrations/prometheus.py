@@ -0,0 +1,31 @@
+from prometheus_client import Counter, Histogram, REGISTRY
+
+from ..metrics import Metrics
+
+
+class PrometheusMetrics(Metrics):
+    """
+    Exports throttling metrics via prometheus_client:
+
+    throttling_decisions_total{rule, result}      - checks of buckets, result is "allowed" or "throttled"
+    throttling_bucket_events_total{rule, event}   - create/refill/spend/lease events of buckets
+                                                    (rate of "create" approximates key cardinality)
+    throttling_storage_seconds{operation}         - latency of redis commands, pipelines and scripts
+    """
+
+    def __init__(self, namespace='', registry=REGISTRY, buckets=Histogram.DEFAULT_BUCKETS):
+        self.decisions = Counter('throttling_decisions', 'Throttling decisions by rule', ['rule', 'result'],
+                                 namespace=namespace, registry=registry)
+        self.events = Counter('throttling_bucket_events', 'Throttling bucket changes by rule', ['rule', 'event'],
+                              namespace=namespace, registry=registry)
+        self.storage = Histogram('throttling_storage_seconds', 'Latency of throttling storage operations',
+                                 ['operation'], namespace=namespace, registry=registry, buckets=buckets)
+
+    def decision(self, rule, key, timeout):
+        self.decisions.labels(rule.cache_key, 'throttled' if timeout else 'allowed').inc()
+
+    def bucket_event(self, rule, key, event, capacity):
+        self.events.labels(rule.cache_key, event).inc()
+
+    def latency(self, operation, seconds):
+        self.storage.labels(operation).observe(seconds)
@@ -1,12 +1,22 @@
+from asyncio import iscoroutinefunction
 from functools import wraps
 
 from .. import ThrottlingOptions
-from ..utils import get_buckets, check_throttle, commit_request, RuleList
+from ..utils import BucketGroup, AsyncBucketGroup, RuleList
 
 
-def throttled(rules: RuleList, arguments_func=None, options: ThrottlingOptions=None):
+def throttled(rules: RuleList, arguments_func=None, options: ThrottlingOptions=None, cost=1, reserve=False,
+              refund_on_error=False, on_throttled=None):
     """
-    Decorator for functions and methods. Once throttled, will skip evaluation and return None
+    Decorator for functions and methods. Once throttled, will skip evaluation and return None.
+    Coroutine functions are throttled asynchronously (via redis.asyncio).
+    :param cost: tokens taken by a call, or a function of the call arguments returning them
+    :param reserve: take tokens before the call with one atomic CHECK_AND_COMMIT script call (whatever
+                    options.use_script is), so concurrent calls can't overrun the limit
+                    (by default tokens are taken after the function returns)
+    :param refund_on_error: with reserve, give the tokens back if the function raises
+    :param on_throttled: function of the throttled BucketGroup (see BucketGroup.timeout, throttled_rules,
+                         rate_limit_headers()), its result is returned instead of None
     """
     if arguments_func is None:
         arguments_func = lambda *a, **kw: dict(args=a, **kw)
@@ -16,13 +26,43 @@ def throttled(rules: RuleList, arguments_func=None, options: ThrottlingOptions=N
         @wraps(func)
         def wrapper(*args, **kwargs):
             arguments_bundle = arguments_func(*args, **kwargs)
-            buckets = get_buckets(rules, arguments_bundle, options)
-            timeout = check_throttle(buckets)
+            group = BucketGroup(rules, arguments_bundle, options,
+                                cost=cost(*args, **kwargs) if callable(cost) else cost, use_script=reserve or None)
+            timeout = group.acquire() if reserve else group.check_throttle()
 
-            if not timeout:
+            if timeout:
+                return on_throttled(group) if on_throttled else None
+            if not reserve:
                 result = func(*args, **kwargs)
-                commit_request(buckets)
+                group.commit_request()
                 return result
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                if refund_on_error:
+                    group.refund()
+                raise
 
-        return wrapper
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            arguments_bundle = arguments_func(*args, **kwargs)
+            group = AsyncBucketGroup(rules, arguments_bundle, options,
+                                     cost=cost(*args, **kwargs) if callable(cost) else cost,
+                                     use_script=reserve or None)
+            timeout = await (group.acquire() if reserve else group.check_throttle())
+
+            if timeout:
+                return on_throttled(group) if on_throttled else None
+            if not reserve:
+                result = await func(*args, **kwargs)
+                await group.commit_request()
+                return result
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                if refund_on_error:
+                    await group.refund()
+                raise
+
+        return async_wrapper if iscoroutinefunction(func) else wrapper
     return decorator
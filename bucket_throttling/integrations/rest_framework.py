@@ -1,18 +1,23 @@
 from rest_framework.exceptions import Throttled
 
 from ..utils import *
-from .django import HttpResponseThrottled
-from ..translation import localize_timedelta
+from .django import HttpResponseThrottled, add_rate_limit_headers, get_request_buckets, retry_after
 
 
 class ThrottledViewSetMixIn:
     """
     Позволяет применять правила троттлинга перед выполнением запросов.
     В пользовательских классах можно задавать правила в throttling_rules
-    и аргументы для создания корзины, возвращаемые в get_throttling_arguments()
+    и аргументы для создания корзины, возвращаемые в get_throttling_arguments().
+    Стоимость запроса в токенах задаётся в throttling_cost или вычисляется в get_throttling_cost().
+    Ответы дополняются заголовками X-RateLimit-* и Retry-After (см. utils.rate_limit_headers),
+    а при throttling_machine_readable отказ содержит {"retry_after": <секунды>} вместо текста
     """
     throttling_rules = None
+    throttling_cost = 1
+    throttling_machine_readable = False
     throttling_distinct_kwargs = False
+    default_key_template = KeyTemplate('user', 'action', 'view')
 
     def initial(self, request, *args, **kwargs):
         """
@@ -21,19 +26,36 @@ class ThrottledViewSetMixIn:
         мы будем иметь пропатченный drf request и все нужные аттрибуты ViewSet'а
         """
         super().initial(request, *args, **kwargs)
-        buckets = self.get_throttling_buckets(request)
-        if buckets:
-            timeout = check_throttle(buckets)
+        group = self.get_throttling_group(request)
+        if group:
+            self.throttling_group = group
+            timeout = group.acquire()
             if timeout:
-                raise ThrottledException(timeout)
-            commit_request(buckets)
+                raise ThrottledException(timeout, self.throttling_machine_readable)
 
-    def get_throttling_buckets(self, request):
-        return get_buckets(self.get_throttling_rules(request), self.get_throttling_arguments(request))
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        return add_rate_limit_headers(response, getattr(self, 'throttling_group', None))
+
+    def get_throttling_group(self, request) -> BucketGroup:
+        return BucketGroup.from_buckets(self.get_throttling_buckets(request), get_request_buckets(request))
+
+    def get_throttling_key_template(self) -> [None, KeyTemplate]:
+        """Для аргументов по умолчанию имена известны заранее"""
+        if not self.throttling_distinct_kwargs and \
+                type(self).get_throttling_arguments is ThrottledViewSetMixIn.get_throttling_arguments:
+            return self.default_key_template
+
+    def get_throttling_buckets(self, request) -> BucketList:
+        return get_buckets(self.get_throttling_rules(request), self.get_throttling_arguments(request),
+                           cost=self.get_throttling_cost(request), key_template=self.get_throttling_key_template())
 
     def get_throttling_rules(self, request):
         return self.throttling_rules
 
+    def get_throttling_cost(self, request) -> int:
+        return self.throttling_cost
+
     def get_throttling_arguments(self, request):
         """аргументы по умолчанию, от которых вычисляется ключ для корзины"""
         d = {
@@ -47,14 +69,13 @@ class ThrottledViewSetMixIn:
 
 
 class ThrottledException(Throttled):
-    def __init__(self, interval=None):
-        if not interval:
-            detail = HttpResponseThrottled.default_detail
-        elif isinstance(interval, timedelta):
-            # без необходимости не отображаем микросекунды
-            if int(interval.total_seconds()) > 0 and interval.microseconds > 0:
-                interval -= timedelta(microseconds=interval.microseconds)
-            detail = HttpResponseThrottled.extra_detail % localize_timedelta(interval)
+    def __init__(self, interval=None, machine_readable=False):
+        # обработчик исключений DRF выставит заголовок Retry-After
+        wait = retry_after(interval) if isinstance(interval, timedelta) else None
+        if machine_readable and wait is not None:
+            super().__init__()
+            # detail задаётся напрямую, чтобы DRF не превратил число в строку
+            self.detail = {'retry_after': wait}
         else:
-            detail = HttpResponseThrottled.extra_detail % str(interval)
-        super().__init__(detail=detail)
+            super().__init__(detail=HttpResponseThrottled.render_detail(interval)[0])
+        self.wait = wait
@@ -0,0 +1,64 @@
+import time
+from threading import Lock
+
+
+class Lease:
+    """Токены ведра, зарезервированные процессом"""
+    __slots__ = ('tokens', 'stamp', 'expires_at')
+
+    def __init__(self, tokens: int, stamp, expires_at: float):
+        self.tokens = tokens
+        self.stamp = stamp          # updated_at ведра на момент резервирования
+        self.expires_at = expires_at
+
+
+class LeaseStore:
+    """
+    Аренды токенов вёдер в памяти процесса (см. ThrottlingRule.lease_size).
+    Пока у аренды есть токены и она не истекла, запросы списываются с неё без обращения к хранилищу.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = Lock()
+        self.leases = {}
+
+    def take(self, key: str, tokens: int = 1) -> bool:
+        """Списывает токены с действующей аренды ведра"""
+        with self.lock:
+            lease = self.leases.get(key)
+            if lease is None or lease.tokens < tokens or lease.expires_at <= self.clock():
+                return False
+            lease.tokens -= tokens
+            return True
+
+    def refund(self, key: str, tokens: int = 1):
+        """Возвращает токены в аренду (запрос не был исполнен)"""
+        with self.lock:
+            lease = self.leases.get(key)
+            if lease is not None:
+                lease.tokens += tokens
+
+    def pop(self, key: str) -> [None, Lease]:
+        """Забирает аренду ведра, чтобы вернуть её неизрасходованные токены в хранилище"""
+        with self.lock:
+            return self.leases.pop(key, None)
+
+    def put(self, key: str, tokens: int, stamp, timeout: float) -> [None, Lease]:
+        """
+        Сохраняет новую аренду. Если другой поток успел получить аренду того же ведра,
+        токены объединяются либо возвращается вытесненная аренда.
+        """
+        with self.lock:
+            lease = self.leases.get(key)
+            if lease is not None and lease.stamp == stamp:
+                lease.tokens += tokens
+                return None
+            self.leases[key] = Lease(tokens, stamp, self.clock() + timeout)
+            return lease
+
+    def pop_all(self) -> list:
+        """Забирает все аренды: [(ключ, аренда), ...]"""
+        with self.lock:
+            leases, self.leases = self.leases, {}
+        return list(leases.items())
@@ -0,0 +1,165 @@
+"""
+Метрики решений и обращений к хранилищу (ThrottlingOptions.metrics).
+Если metrics не задан, вёдра не вызывают никаких методов, а хранилище не оборачивается.
+"""
+import logging
+from datetime import timedelta
+from time import perf_counter
+
+from .scripts import CHECK_AND_COMMIT, LEASE, RETURN_LEASE, REFUND
+
+# имена скриптов для Metrics.latency()
+SCRIPT_NAMES = {
+    CHECK_AND_COMMIT: 'check_and_commit',
+    LEASE: 'lease',
+    RETURN_LEASE: 'return_lease',
+    REFUND: 'refund',
+}
+
+
+class Metrics:
+    """
+    Получатель метрик. Методы по умолчанию ничего не делают, наследники переопределяют нужные.
+    Кол-во уникальных ключей можно оценить по событиям create: ведро создаётся один раз
+    для каждого набора аргументов за таймаут кэша.
+    """
+
+    def decision(self, rule, key: str, timeout: [None, timedelta]):
+        """Результат проверки ведра правила rule: пустой timeout - запрос разрешён"""
+
+    def bucket_event(self, rule, key: str, event: str, capacity: int):
+        """
+        Изменение ведра:
+        create - ведро создано, refill - ёмкость пополнена по истечении интервала, spend - списан запрос,
+        lease - процессу выдана аренда capacity токенов
+        """
+
+    def latency(self, operation: str, seconds: float):
+        """Длительность обращения к хранилищу: команда, pipeline или скрипт (см. SCRIPT_NAMES)"""
+
+
+class LoggingMetrics(Metrics):
+    """
+    Пишет решения и события вёдер в logging (по умолчанию логгер bucket_throttling, уровень DEBUG),
+    а обращения к хранилищу дольше slow_operation секунд - с уровнем WARNING.
+    Используется при ThrottlingOptions.verbose_mode.
+    """
+
+    def __init__(self, logger: logging.Logger=None, level=logging.DEBUG, slow_operation=0.1):
+        self.logger = logger or logging.getLogger('bucket_throttling')
+        self.level = level
+        self.slow_operation = slow_operation
+
+    def decision(self, rule, key: str, timeout: [None, timedelta]):
+        if timeout:
+            self.logger.log(self.level, 'throttled %s for %s', key, timeout)
+        else:
+            self.logger.log(self.level, 'allowed %s', key)
+
+    def bucket_event(self, rule, key: str, event: str, capacity: int):
+        self.logger.log(self.level, '%s %s (%d capacity)', event, key, capacity)
+
+    def latency(self, operation: str, seconds: float):
+        if seconds >= self.slow_operation:
+            self.logger.warning('slow %s: %.3f s', operation, seconds)
+
+
+class InstrumentedStorage:
+    """Обёртка хранилища, сообщающая Metrics.latency() длительность каждого обращения"""
+
+    def __init__(self, storage, metrics: Metrics):
+        self.storage = storage
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+        metrics = self.metrics
+
+        def command(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                metrics.latency(name, perf_counter() - started)
+        return command
+
+    def pipeline(self, transaction=True):
+        return InstrumentedPipeline(self.storage.pipeline(transaction), self.metrics)
+
+    def register_script(self, script: str):
+        name = SCRIPT_NAMES.get(script, 'script')
+        registered = self.storage.register_script(script)
+        metrics = self.metrics
+
+        def call(keys=(), args=(), client=None):
+            if client is not None:
+                # вызов в pipeline учитывается в длительности его execute()
+                return registered(keys=keys, args=args, client=client.pipeline)
+            started = perf_counter()
+            try:
+                return registered(keys=keys, args=args)
+            finally:
+                metrics.latency(name, perf_counter() - started)
+        return call
+
+
+class InstrumentedPipeline:
+
+    def __init__(self, pipeline, metrics: Metrics):
+        self.pipeline = pipeline
+        self.metrics = metrics
+
+    def __len__(self):
+        return len(self.pipeline)
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+    def execute(self) -> list:
+        started = perf_counter()
+        try:
+            return self.pipeline.execute()
+        finally:
+            self.metrics.latency('pipeline', perf_counter() - started)
+
+
+class AsyncInstrumentedStorage(InstrumentedStorage):
+    """InstrumentedStorage для асинхронного хранилища (ThrottlingOptions.async_redis)"""
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+        metrics = self.metrics
+
+        async def command(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                metrics.latency(name, perf_counter() - started)
+        return command
+
+    def pipeline(self, transaction=True):
+        return AsyncInstrumentedPipeline(self.storage.pipeline(transaction), self.metrics)
+
+    def register_script(self, script: str):
+        name = SCRIPT_NAMES.get(script, 'script')
+        registered = self.storage.register_script(script)
+        metrics = self.metrics
+
+        async def call(keys=(), args=()):
+            started = perf_counter()
+            try:
+                return await registered(keys=keys, args=args)
+            finally:
+                metrics.latency(name, perf_counter() - started)
+        return call
+
+
+class AsyncInstrumentedPipeline(InstrumentedPipeline):
+
+    async def execute(self) -> list:
+        started = perf_counter()
+        try:
+            return await self.pipeline.execute()
+        finally:
+            self.metrics.latency('pipeline', perf_counter() - started)
@@ -0,0 +1,260 @@
+"""
+Lua-скрипты, исполняемые на стороне Redis.
+Регистрируются через StrictRedis.register_script: скрипт загружается один раз
+и далее вызывается по EVALSHA.
+"""
+
+# Проверяет вёдра и, если ни одно не переполнено, фиксирует в них запрос.
+# Всё выполняется атомарно, за одно обращение к Redis.
+#
+# KEYS - ключи вёдер
+# ARGV[1] - текущий timestamp (сек) или пустая строка, чтобы взять время Redis (см. ThrottlingOptions.server_time)
+# ARGV[2..] - по пять значений на каждое ведро: алгоритм (ThrottlingRule.algorithm),
+#             max_requests, интервал (сек), таймаут кэша (сек), стоимость запроса (токенов)
+#
+# Алгоритмы:
+#   bucket - ведро с пополнением раз в интервал (см. ThrottlingBucket.commit_request), хэш capacity/updated_at
+#   gcra   - Generic Cell Rate Algorithm (см. GCRARule), строка с theoretical arrival time
+#   window - скользящее окно (см. SlidingWindowRule), хэш window/current/previous
+#
+# Возвращает {allowed, remaining_1, retry_after_ms_1, reset_ms_1, remaining_2, ...},
+# где reset_ms - время до пополнения ведра (bucket), его полного восстановления (gcra) или конца окна (window)
+CHECK_AND_COMMIT = """
+local now = tonumber(ARGV[1])
+local stamp = ARGV[1]
+if now == nil then
+    local time = redis.call('TIME')
+    now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    stamp = string.format('%.6f', now)
+end
+local states = {}
+local retries = {}
+local allowed = 1
+
+local function rule(i)
+    local offset = (i - 1) * 5 + 2
+    return ARGV[offset], tonumber(ARGV[offset + 1]), tonumber(ARGV[offset + 2]), tonumber(ARGV[offset + 3]),
+        tonumber(ARGV[offset + 4])
+end
+
+for i = 1, #KEYS do
+    local algorithm, max_requests, interval, cache_interval, cost = rule(i)
+    local retry = 0
+
+    if algorithm == 'gcra' then
+        local emission = interval / max_requests
+        local tat = math.max(tonumber(redis.call('GET', KEYS[i])) or now, now)
+        states[i] = {tat}
+        if tat + emission * cost - interval > now then
+            retry = tat + emission * cost - interval - now
+        end
+
+    elseif algorithm == 'window' then
+        local window = math.floor(now / interval)
+        local state = redis.call('HMGET', KEYS[i], 'window', 'current', 'previous')
+        local current = tonumber(state[2]) or 0
+        local previous = tonumber(state[3]) or 0
+        if tonumber(state[1]) == window - 1 then
+            previous = current
+            current = 0
+        elseif tonumber(state[1]) ~= window then
+            previous = 0
+            current = 0
+        end
+        local elapsed = now - window * interval
+        local limit = max_requests - cost
+        states[i] = {window, current, previous, elapsed}
+        if previous * (1 - elapsed / interval) + current > limit then
+            if current > limit then
+                retry = interval - elapsed + interval * (1 - limit / current)
+            else
+                retry = interval * (1 - (limit - current) / previous) - elapsed
+            end
+        end
+
+    else
+        local state = redis.call('HMGET', KEYS[i], 'capacity', 'updated_at')
+        local capacity = tonumber(state[1])
+        local updated_at = tonumber(state[2])
+        states[i] = {capacity, updated_at}
+        if updated_at ~= nil and updated_at + interval > now then
+            if (capacity or 0) < cost then
+                retry = updated_at + interval - now
+            end
+        elseif updated_at ~= nil and (capacity or 0) + max_requests < cost then
+            retry = interval
+        end
+    end
+
+    -- стоимость запроса больше, чем ведро может вместить
+    if cost > max_requests then
+        retry = interval
+    end
+    retries[i] = 0
+    if retry > 0 then
+        retries[i] = math.ceil(retry * 1000)
+        allowed = 0
+    end
+end
+
+local ret = {allowed}
+for i = 1, #KEYS do
+    local algorithm, max_requests, interval, cache_interval, cost = rule(i)
+    local state = states[i]
+    local remaining = 0
+    local reset = 0
+
+    if algorithm == 'gcra' then
+        local emission = interval / max_requests
+        local tat = state[1]
+        if allowed == 1 then
+            tat = tat + emission * cost
+            redis.call('SET', KEYS[i], string.format('%.6f', tat), 'PX', math.ceil((tat - now) * 1000))
+        end
+        remaining = math.max(math.floor((interval - (tat - now)) / emission + 1e-6), 0)
+        reset = math.max(tat - now, 0)
+
+    elseif algorithm == 'window' then
+        local window, current, previous, elapsed = state[1], state[2], state[3], state[4]
+        if allowed == 1 then
+            current = current + cost
+            redis.call('HMSET', KEYS[i], 'window', window, 'current', current, 'previous', previous)
+            redis.call('EXPIRE', KEYS[i], math.ceil(interval * 2))
+        end
+        remaining = math.max(math.floor(max_requests - previous * (1 - elapsed / interval) - current + 1e-6), 0)
+        reset = interval - elapsed
+
+    else
+        local capacity, updated_at = state[1], state[2]
+        local max_capacity = max_requests - cost
+        if allowed == 1 then
+            if updated_at == nil then
+                capacity = max_capacity
+                redis.call('HMSET', KEYS[i], 'capacity', capacity, 'updated_at', stamp)
+                redis.call('EXPIRE', KEYS[i], cache_interval)
+            elseif updated_at < now - interval then
+                capacity = (capacity or 0) + max_capacity
+                redis.call('HMSET', KEYS[i], 'capacity', capacity, 'updated_at', stamp)
+                redis.call('EXPIRE', KEYS[i], cache_interval)
+            else
+                capacity = redis.call('HINCRBY', KEYS[i], 'capacity', -cost)
+            end
+            if updated_at == nil or updated_at < now - interval then
+                updated_at = now
+            end
+        end
+        remaining = capacity or 0
+        if updated_at ~= nil and updated_at + interval > now then
+            reset = updated_at + interval - now
+        end
+    end
+
+    ret[#ret + 1] = remaining
+    ret[#ret + 1] = retries[i]
+    ret[#ret + 1] = math.ceil(reset * 1000)
+end
+return ret
+"""
+
+# Резервирует для процесса до lease_size токенов ведра (см. ThrottlingRule.lease_size), но не меньше стоимости запроса.
+#
+# KEYS[1] - ключ ведра
+# ARGV - текущий timestamp (как в CHECK_AND_COMMIT), max_requests, интервал (сек), таймаут кэша (сек), lease_size,
+#        стоимость запроса
+#
+# Возвращает {кол-во выданных токенов, время до пополнения ведра (мс), updated_at ведра}.
+# Если токены не выданы, запрос ждёт пополнения ведра, иначе до него действует аренда.
+LEASE = """
+local now = tonumber(ARGV[1])
+local now_stamp = ARGV[1]
+if now == nil then
+    local time = redis.call('TIME')
+    now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    now_stamp = string.format('%.6f', now)
+end
+local max_requests = tonumber(ARGV[2])
+local interval = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'capacity', 'updated_at')
+local capacity = tonumber(state[1])
+local updated_at = tonumber(state[2])
+local stamp = state[2]
+local available = capacity or 0
+local refill_ms = math.ceil(interval * 1000)
+
+if updated_at == nil then
+    available = max_requests
+    stamp = now_stamp
+elseif updated_at < now - interval then
+    available = (capacity or 0) + max_requests
+    stamp = now_stamp
+else
+    refill_ms = math.ceil((updated_at + interval - now) * 1000)
+end
+
+local grant = math.min(tonumber(ARGV[5]), available)
+if grant < tonumber(ARGV[6]) then
+    -- если ведро только что пополнено, не хватает даже полного ведра
+    return {0, refill_ms, stamp}
+end
+
+if stamp == now_stamp then
+    redis.call('HMSET', KEYS[1], 'capacity', available - grant, 'updated_at', stamp)
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]))
+else
+    redis.call('HINCRBY', KEYS[1], 'capacity', -grant)
+end
+return {grant, refill_ms, stamp}
+"""
+
+# Возвращает в ведро неизрасходованные токены аренды, если ведро не обновлялось с момента её получения.
+#
+# KEYS[1] - ключ ведра
+# ARGV - updated_at ведра на момент аренды, кол-во токенов
+RETURN_LEASE = """
+if redis.call('HGET', KEYS[1], 'updated_at') == ARGV[1] then
+    return redis.call('HINCRBY', KEYS[1], 'capacity', tonumber(ARGV[2]))
+end
+return false
+"""
+
+# Возвращает в вёдра токены зафиксированного запроса, который не был исполнен (см. utils.refund_request).
+#
+# KEYS - ключи вёдер
+# ARGV[1] - текущий timestamp (как в CHECK_AND_COMMIT)
+# ARGV[2..] - по четыре значения на каждое ведро: алгоритм, max_requests, интервал (сек), стоимость запроса
+REFUND = """
+local now = tonumber(ARGV[1])
+if now == nil then
+    local time = redis.call('TIME')
+    now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+end
+
+for i = 1, #KEYS do
+    local offset = (i - 1) * 4 + 2
+    local algorithm, max_requests = ARGV[offset], tonumber(ARGV[offset + 1])
+    local interval, cost = tonumber(ARGV[offset + 2]), tonumber(ARGV[offset + 3])
+
+    if algorithm == 'gcra' then
+        local tat = tonumber(redis.call('GET', KEYS[i]))
+        if tat ~= nil then
+            tat = tat - interval / max_requests * cost
+            if tat > now then
+                redis.call('SET', KEYS[i], string.format('%.6f', tat), 'PX', math.max(math.ceil((tat - now) * 1000), 1))
+            else
+                redis.call('DEL', KEYS[i])
+            end
+        end
+
+    elseif algorithm == 'window' then
+        local state = redis.call('HMGET', KEYS[i], 'window', 'current')
+        -- запрос учтён в текущем окне, которое могло стать предыдущим
+        if tonumber(state[1]) ~= nil and tonumber(state[1]) >= math.floor(now / interval) - 1 then
+            redis.call('HSET', KEYS[i], 'current', math.max(tonumber(state[2]) - cost, 0))
+        end
+
+    elseif redis.call('HEXISTS', KEYS[i], 'updated_at') == 1 then
+        redis.call('HINCRBY', KEYS[i], 'capacity', cost)
+    end
+end
+return #KEYS
+"""
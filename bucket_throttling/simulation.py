@@ -0,0 +1,244 @@
+"""
+Воспроизведение журнала запросов для подбора правил (см. simulate.py).
+
+События журнала (момент запроса и его аргументы) проверяются теми же вёдрами, что и в работе
+(utils.check_throttle и commit_request), но в MemoryBackend и по виртуальным часам,
+которые идут по меткам времени событий.
+Поэтому журнал воспроизводится без ожидания реального времени,
+а решения совпадают с решениями при тех же правилах в redis.
+
+События читаются генераторами и не накапливаются: в памяти остаются только живые вёдра
+и по одному числу на набор аргументов для статистики.
+"""
+import csv
+import gzip
+import heapq
+import json
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Iterable, Iterator
+
+from . import ThrottlingOptions, ThrottlingRule, KeyTemplate
+from .backends import MemoryBackend
+from .lease import LeaseStore
+from .utils import RuleList, check_throttle, commit_request, _arguments_keys
+
+# статистика набора аргументов хранится одним числом: младшие разряды - кол-во запросов, старшие - отклонённых
+_REQUESTS_BITS = 40
+_REQUEST = 1
+_THROTTLED = 1 + (1 << _REQUESTS_BITS)
+
+
+class VirtualClock:
+    """Время симуляции (unix timestamp, сек): метка времени текущего события журнала"""
+    now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class SimulationReport:
+    """
+    Результат воспроизведения журнала.
+
+    requests, throttled - кол-во запросов и отклонённых из них
+    rules               - кол-во отклонённых запросов по правилам, вёдра которых оказались переполнены
+                          (проверка обычных вёдер останавливается на первом переполненном, см. utils.check_throttle)
+    peak_buckets        - наибольшее кол-во живых вёдер в хранилище (считается раз в purge_interval)
+    peak_memory         - наибольший объём памяти симуляции (байт), если она запущена с trace_memory
+    started_at, finished_at - метки времени первого и последнего события
+    reordered           - кол-во событий, метка времени которых меньше предыдущей (они учитываются в момент предыдущей)
+    elapsed             - время воспроизведения (сек)
+    """
+
+    def __init__(self, rules: RuleList):
+        self.requests = 0
+        self.throttled = 0
+        self.rules = {rule: 0 for rule in rules}
+        self.keys = {}
+        self.peak_buckets = 0
+        self.peak_memory = None
+        self.started_at = None
+        self.finished_at = None
+        self.reordered = 0
+        self.elapsed = 0.0
+
+    @property
+    def throttle_rate(self) -> float:
+        """Доля отклонённых запросов"""
+        return self.throttled / self.requests if self.requests else 0.0
+
+    @property
+    def throttled_keys(self) -> int:
+        """Кол-во наборов аргументов, у которых был отклонён хотя бы один запрос"""
+        return sum(1 for value in self.keys.values() if value >> _REQUESTS_BITS)
+
+    def key_stats(self, key: str) -> tuple:
+        """Кол-во запросов и отклонённых из них для ключа аргументов (ThrottlingOptions.arguments_key)"""
+        throttled, requests = divmod(self.keys.get(key, 0), 1 << _REQUESTS_BITS)
+        return requests, throttled
+
+    def top_keys(self, count=10) -> list:
+        """Наборы аргументов с наибольшим кол-вом отклонённых запросов: [(ключ, запросов, отклонено), ...]"""
+        top = heapq.nlargest(count, self.keys.items(), key=lambda item: (item[1] >> _REQUESTS_BITS, item[1]))
+        return [(key,) + self.key_stats(key) for key, value in top if value >> _REQUESTS_BITS]
+
+    def as_dict(self, top=10) -> dict:
+        return {
+            'requests': self.requests,
+            'throttled': self.throttled,
+            'throttle_rate': round(self.throttle_rate, 6),
+            'keys': len(self.keys),
+            'throttled_keys': self.throttled_keys,
+            'rules': {rule.cache_key: count for rule, count in self.rules.items()},
+            'top_keys': [dict(key=key, requests=requests, throttled=throttled,
+                              throttle_rate=round(throttled / requests, 6))
+                         for key, requests, throttled in self.top_keys(top)],
+            'peak_buckets': self.peak_buckets,
+            'peak_memory': self.peak_memory,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'reordered': self.reordered,
+            'elapsed': round(self.elapsed, 3),
+            'events_per_second': round(self.requests / self.elapsed) if self.elapsed else None,
+        }
+
+
+class Simulation:
+    """
+    Проверяет события журнала правилами rules: каждое событие - один запрос (check_throttle и commit_request).
+    Вёдра хранятся в MemoryBackend, время вёдер и хранилища задаётся виртуальными часами.
+    События должны идти по возрастанию времени (как в журнале доступа).
+    """
+
+    def __init__(self, rules: [RuleList, ThrottlingRule], periods_to_overtake=0, use_script=False,
+                 cost: [int, Callable]=1, key_template: KeyTemplate=None, max_size=10 ** 9, purge_interval=60,
+                 trace_memory=False):
+        """
+        :param cost: стоимость запроса в токенах или функция аргументов запроса, возвращающая её
+        :param key_template: скомпилированный ключ, если имена аргументов событий известны заранее
+        :param max_size: максимальное кол-во вёдер в хранилище (при превышении вытесняются давно не использовавшиеся)
+        :param purge_interval: интервал (сек виртуального времени) удаления просроченных вёдер и подсчёта живых
+        :param trace_memory: измерять объём памяти через tracemalloc (замедляет воспроизведение в несколько раз)
+        """
+        if isinstance(rules, ThrottlingRule):
+            rules = [rules]
+        self.rules = rules
+        self.cost = cost
+        self.key_template = key_template
+        self.purge_interval = purge_interval
+        self.trace_memory = trace_memory
+        self.clock = VirtualClock()
+        self.backend = MemoryBackend(max_size=max_size, shards=1, clock=self.clock)
+        self.options = ThrottlingOptions(periods_to_overtake=periods_to_overtake, use_script=use_script,
+                                         backend=self.backend, clock=self.clock)
+        # аренды токенов тоже истекают по виртуальным часам
+        self.options.lease_store = LeaseStore(clock=self.clock)
+
+    def _purge(self, report: SimulationReport):
+        self.backend.purge()
+        report.peak_buckets = max(report.peak_buckets, len(self.backend))
+
+    def run(self, events: Iterable[tuple]) -> SimulationReport:
+        """
+        Воспроизводит события и возвращает статистику решений
+        :param events: пары (unix timestamp, словарь аргументов запроса), например из read_events()
+        """
+        report = SimulationReport(self.rules)
+        if self.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            self._run(events, report)
+        finally:
+            report.elapsed = time.perf_counter() - started
+            if self.trace_memory:
+                report.peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        return report
+
+    def _run(self, events: Iterable[tuple], report: SimulationReport):
+        clock, options, rules, key_template = self.clock, self.options, self.rules, self.key_template
+        bucket_classes = [options.get_bucket_class(rule) for rule in rules]
+        scoped = any(rule.scope is not None for rule in rules)
+        hash_tag = None
+        cost = self.cost if callable(self.cost) else None
+        keys = report.keys
+        rule_counts = report.rules
+        next_purge = None
+
+        for timestamp, arguments in events:
+            if timestamp >= clock.now:
+                clock.now = timestamp
+            else:
+                report.reordered += 1
+            if next_purge is None:
+                report.started_at = timestamp
+                next_purge = timestamp + self.purge_interval
+
+            # вёдра создаются как в utils.get_buckets, но ключ аргументов строится один раз и для статистики
+            key = options.arguments_key(arguments, key_template)
+            if scoped:
+                arguments_keys, hash_tag = _arguments_keys(rules, arguments, options, key_template)
+            else:
+                arguments_keys = [key] * len(rules)
+            request_cost = cost(arguments) if cost else self.cost
+            buckets = [bucket_class(rule, arguments, options, arguments_key=arguments_key, cost=request_cost,
+                                    hash_tag=hash_tag)
+                       for bucket_class, rule, arguments_key in zip(bucket_classes, rules, arguments_keys)]
+            if check_throttle(buckets):
+                keys[key] = keys.get(key, 0) + _THROTTLED
+                report.throttled += 1
+                for b in buckets:
+                    if b.timeout:
+                        rule_counts[b.rule] += 1
+            else:
+                commit_request(buckets)
+                keys[key] = keys.get(key, 0) + _REQUEST
+            report.requests += 1
+            if clock.now >= next_purge:
+                self._purge(report)
+                next_purge = clock.now + self.purge_interval
+
+        report.finished_at = clock.now if next_purge is not None else None
+        self._purge(report)
+
+
+def parse_timestamp(value) -> float:
+    """Метка времени события: unix timestamp (сек) или дата в ISO 8601"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def _open(path: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', newline='')
+    return open(path, newline='')
+
+
+def read_events(path: str, timestamp_field='timestamp', arguments: list = None, log_format: str = None) -> Iterator:
+    """
+    Читает события из журнала CSV (с заголовком) или JSONL, в том числе сжатого gzip.
+    Возвращает генератор пар (unix timestamp, словарь аргументов запроса).
+
+    :param timestamp_field: поле с меткой времени (см. parse_timestamp)
+    :param arguments: поля, из которых строятся аргументы запроса (по умолчанию все, кроме метки времени)
+    :param log_format: csv или jsonl, по умолчанию определяется по расширению файла
+    """
+    if log_format is None:
+        name = path[:-3] if path.endswith('.gz') else path
+        log_format = 'csv' if name.endswith('.csv') else 'jsonl'
+    with _open(path) as f:
+        rows = csv.DictReader(f) if log_format == 'csv' else (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            timestamp = parse_timestamp(row[timestamp_field])
+            if arguments is None:
+                del row[timestamp_field]
+                yield timestamp, row
+            else:
+                yield timestamp, {name: row[name] for name in arguments}
@@ -9,35 +9,33 @@ def localize_timedelta(delta: timedelta, include_milliseconds=True) -> str:
     """
     ret = []
     sign_string = ''
-    seconds = delta.total_seconds()
-    if seconds < 0:
+    if delta < timedelta():
         sign_string = '-'
         delta = -delta
 
-    num_years = int(delta.days / 365)
+    # разложение на единицы целочисленной арифметикой, без промежуточных timedelta
+    seconds, microseconds = divmod(delta // timedelta(microseconds=1), 1000000)
+    days, seconds = divmod(seconds, 86400)
+    num_years, days = divmod(days, 365)
+    num_hours, seconds = divmod(seconds, 3600)
+    num_minutes, num_seconds = divmod(seconds, 60)
+
     if num_years > 0:
-        delta -= timedelta(days=num_years * 365)
         ret.append(ng('%d year', '%d years', num_years) % num_years)
 
-    if delta.days > 0:
-        ret.append(ng('%d day', '%d days', delta.days) % delta.days)
+    if days > 0:
+        ret.append(ng('%d day', '%d days', days) % days)
 
-    num_hours = int(delta.seconds / 3600)
     if num_hours > 0:
-        delta -= timedelta(hours=num_hours)
         ret.append(ng('%d hour', '%d hours', num_hours) % num_hours)
 
-    num_minutes = int(delta.seconds / 60)
     if num_minutes > 0:
-        delta -= timedelta(minutes=num_minutes)
         ret.append(ng('%d minute', '%d minutes', num_minutes) % num_minutes)
 
-    num_seconds = delta.seconds
     if num_seconds > 0:
-        delta -= timedelta(seconds=num_seconds)
         ret.append(ng('%d second', '%d seconds', num_seconds) % num_seconds)
 
-    num_milliseconds = int(delta.microseconds / 1000)
+    num_milliseconds = microseconds // 1000
     if num_milliseconds > 0 and include_milliseconds:
         ret.append(ng('%d ms', '%d ms', num_milliseconds) % num_milliseconds)
 
@@ -1,35 +1,518 @@
-from typing import List
+import math
+from itertools import islice
+from typing import Iterable, List
 
-from . import ThrottlingBucket, ThrottlingRule, ThrottlingOptions
+from . import ThrottlingBucket, ScriptedThrottlingBucket, AsyncScriptedThrottlingBucket, LeasedThrottlingBucket, \
+    ThrottlingRule, ThrottlingOptions, KeyTemplate, defaultThrottlingOptions
+from .scripts import CHECK_AND_COMMIT, REFUND
 from datetime import timedelta
 
 
 RuleList = List[ThrottlingRule]
 BucketList = List[ThrottlingBucket]
 
+# вёдра, в которых check_throttle() сразу фиксирует запрос
+SELF_COMMITTING = (ScriptedThrottlingBucket, LeasedThrottlingBucket)
 
-def get_buckets(rules: RuleList, arguments_bundle: dict, options: ThrottlingOptions=None) -> BucketList:
+
+def get_buckets(rules: RuleList, arguments_bundle: dict, options: ThrottlingOptions=None, cost=1,
+                key_template: KeyTemplate=None) -> BucketList:
     """
     Возвращает вёдра, созданные путём комбинации списка правил с аргументами запроса.
+    :param cost: кол-во токенов, списываемых запросом с каждого ведра
+    :param key_template: скомпилированный ключ для набора аргументов, если их имена известны заранее
     """
     ret = []
     if not rules:
         return ret
-    for rule in rules:
-        ret.append(ThrottlingBucket(rule, arguments_bundle, options))
+    options = options or defaultThrottlingOptions
+    keys, hash_tag = _arguments_keys(rules, arguments_bundle, options, key_template)
+    for rule, arguments_key in zip(rules, keys):
+        ret.append(options.get_bucket_class(rule)(rule, arguments_bundle, options, arguments_key=arguments_key,
+                                                  cost=cost, hash_tag=hash_tag))
     return ret
 
 
-def check_throttle(buckets: BucketList) -> timedelta:
-    """Возвращает интервал, который осталось подождать до истечения таймаута вёдер"""
+def _arguments_keys(rules: RuleList, arguments_bundle: dict, options: ThrottlingOptions,
+                    key_template: KeyTemplate=None) -> tuple:
+    """
+    Ключи аргументов для вёдер правил (см. ThrottlingRule.scope) и общий hash tag вёдер.
+    Hash tag нужен, только если ключи правил различаются: он строится из аргументов, общих для всех правил,
+    чтобы вёдра иерархии попали в один слот Redis Cluster.
+    """
+    scopes = {}
+    keys = []
+    for rule in rules:
+        if rule.scope not in scopes:
+            if rule.scope is None:
+                scopes[None] = options.arguments_key(arguments_bundle, key_template)
+            else:
+                scopes[rule.scope] = options.arguments_key(rule.scope_arguments(arguments_bundle))
+        keys.append(scopes[rule.scope])
+
+    hash_tag = None
+    if len(scopes) > 1 and options.use_hash_tags:
+        common = set(arguments_bundle)
+        for scope in scopes:
+            if scope is not None:
+                common &= set(scope)
+        hash_tag = options.arguments_key({name: arguments_bundle[name] for name in common}) if common else ''
+    return keys, hash_tag
+
+
+def _max_timeout(timeouts) -> timedelta:
     ret = timedelta()
-    for b in buckets:
-        t = b.check_throttle()
+    for t in timeouts:
         if t and t > ret:
             ret = t
     return ret
 
 
+def _strictest_first(buckets: BucketList) -> BucketList:
+    """Вёдра в порядке проверки: начиная с самого строгого правила (см. ThrottlingRule.rate)"""
+    return sorted(buckets, key=lambda b: b.rule.rate)
+
+
+def _first_timeout(buckets: BucketList) -> timedelta:
+    """
+    Проверяет вёдра, начиная с самого строгого правила. После первого переполненного ведра проверяются
+    только вёдра с уже прочитанным состоянием (BucketGroup читает все вёдра одним pipeline), а остальные
+    не читаются вовсе. Возвращает наибольший интервал ожидания среди проверенных вёдер
+    """
+    ret = timedelta()
+    for b in _strictest_first(buckets):
+        if not ret or b.loaded:
+            ret = _max_timeout([ret, b.check_throttle()])
+    return ret
+
+
+async def _async_first_timeout(buckets: BucketList) -> timedelta:
+    """Асинхронный вариант _first_timeout"""
+    ret = timedelta()
+    for b in _strictest_first(buckets):
+        if not ret or b.loaded:
+            ret = _max_timeout([ret, await b.check_throttle()])
+    return ret
+
+
+def _group_scripted(buckets: BucketList, bucket_class) -> list:
+    """Группирует вёдра, проверяемые скриптом, по настройкам (то есть по хранилищу)"""
+    ret = {}
+    for b in buckets:
+        if isinstance(b, bucket_class):
+            ret.setdefault(id(b.options), []).append(b)
+    return list(ret.values())
+
+
+def local_throttle(buckets: BucketList) -> timedelta:
+    """Интервал ожидания по локальному кэшу переполненных вёдер, без обращения к хранилищу"""
+    timeouts = [b.local_throttle() for b in buckets]
+    ret = _max_timeout(timeouts)
+    if ret:
+        # запрос отклоняется без проверки остальных вёдер
+        for b, timeout in zip(buckets, timeouts):
+            if timeout:
+                b._report(timeout)
+    return ret
+
+
+def check_throttle(buckets: BucketList) -> timedelta:
+    """Возвращает интервал, который осталось подождать до истечения таймаута вёдер"""
+    ret = local_throttle(buckets)
+    if ret:
+        return ret
+
+    # арендованные вёдра проверяются первыми: обычно это не требует обращения к хранилищу,
+    # а списанный токен можно вернуть в аренду, если запрос отклонят другие вёдра.
+    # Затем вёдра, которые только проверяются, и в последнюю очередь - скрипт, сразу фиксирующий запрос.
+    # После первого переполненного ведра непрочитанные вёдра не проверяются (см. _first_timeout)
+    leased = [b for b in buckets if isinstance(b, LeasedThrottlingBucket)]
+    ret = _first_timeout(leased)
+    if not ret:
+        ret = _first_timeout([b for b in buckets if not isinstance(b, SELF_COMMITTING)])
+    if not ret:
+        for group in _group_scripted(buckets, ScriptedThrottlingBucket):
+            ScriptedThrottlingBucket.evaluate(group)
+        ret = _max_timeout([b.check_throttle() for b in buckets if isinstance(b, ScriptedThrottlingBucket)])
+
+    if ret:
+        for b in leased:
+            b.refund()
+    return ret
+
+
 def commit_request(buckets: BucketList):
     """Уведомляет каждое ведро о том, что запрос исполнен"""
     [b.commit_request() for b in buckets]
+
+
+def refund_request(buckets: BucketList):
+    """Возвращает в вёдра токены зафиксированного запроса, который в итоге не был исполнен"""
+    for b in buckets:
+        if isinstance(b, LeasedThrottlingBucket):
+            b.refund()
+    for group in _group_scripted([b for b in buckets if not isinstance(b, LeasedThrottlingBucket)], ThrottlingBucket):
+        keys, args = ThrottlingBucket._refund_arguments(group)
+        group[0].options.script(REFUND)(keys=keys, args=args)
+
+
+def rate_limit_headers(buckets: BucketList, timeout: timedelta=None) -> dict:
+    """
+    HTTP-заголовки состояния лимита по ведру, ближайшему к исчерпанию: X-RateLimit-Limit,
+    X-RateLimit-Remaining и X-RateLimit-Reset (сек до пополнения ведра), а для отклонённого запроса - Retry-After (сек).
+    Вёдра с неизвестной ёмкостью (арендованные или отклонённые по локальному кэшу) не учитываются.
+    """
+    ret = {}
+    known = [b for b in buckets if b.remaining is not None]
+    if known:
+        bucket = min(known, key=lambda b: b.remaining)
+        ret['X-RateLimit-Limit'] = str(bucket.rule.max_requests)
+        ret['X-RateLimit-Remaining'] = str(max(bucket.remaining, 0))
+        ret['X-RateLimit-Reset'] = str(math.ceil(bucket.reset_after.total_seconds()) if bucket.reset_after else 0)
+    if timeout:
+        ret['Retry-After'] = str(math.ceil(timeout.total_seconds()))
+    return ret
+
+
+async def async_get_buckets(rules: RuleList, arguments_bundle: dict, options: ThrottlingOptions=None) -> BucketList:
+    """Асинхронный вариант get_buckets: состояние всех вёдер читается одним pipeline"""
+    group = AsyncBucketGroup(rules, arguments_bundle, options)
+    await group._load()
+    return group.buckets
+
+
+async def async_check_throttle(buckets: BucketList) -> timedelta:
+    """Асинхронный вариант check_throttle"""
+    ret = local_throttle(buckets)
+    if ret:
+        return ret
+
+    leased = [b for b in buckets if isinstance(b, LeasedThrottlingBucket)]
+    ret = await _async_first_timeout(leased)
+    if not ret:
+        ret = await _async_first_timeout([b for b in buckets if not isinstance(b, SELF_COMMITTING)])
+    if not ret:
+        for group in _group_scripted(buckets, AsyncScriptedThrottlingBucket):
+            await AsyncScriptedThrottlingBucket.evaluate(group)
+        ret = _max_timeout([await b.check_throttle() for b in buckets if isinstance(b, ScriptedThrottlingBucket)])
+
+    if ret:
+        for b in leased:
+            b.refund()
+    return ret
+
+
+async def async_commit_request(buckets: BucketList):
+    """Асинхронный вариант commit_request"""
+    for b in buckets:
+        await b.commit_request()
+
+
+async def async_refund_request(buckets: BucketList):
+    """Асинхронный вариант refund_request"""
+    for b in buckets:
+        if isinstance(b, LeasedThrottlingBucket):
+            b.refund()
+    for group in _group_scripted([b for b in buckets if not isinstance(b, LeasedThrottlingBucket)], ThrottlingBucket):
+        keys, args = ThrottlingBucket._refund_arguments(group)
+        await group[0].options.async_script(REFUND)(keys=keys, args=args)
+
+
+def acquire_batch(rules: [RuleList, ThrottlingRule], bundles: Iterable[dict], options: ThrottlingOptions=None,
+                  key_template: KeyTemplate=None, consume_denied=False, chunk_size=100, cost=1) -> List[timedelta]:
+    """
+    Проверяет и фиксирует пачку запросов (например, сообщений из очереди) с разными наборами аргументов.
+    Для каждого набора возвращает интервал ожидания, как BucketGroup.acquire(): пустой, если запрос разрешён.
+    Запросы учитываются по порядку, как при последовательных вызовах acquire(), но состояние вёдер
+    читается и записывается pipeline'ами - по одному на chunk_size наборов аргументов.
+    Если среди правил есть проверяемые скриптом, все вёдра пачки проверяются скриптом CHECK_AND_COMMIT.
+
+    :param consume_denied: отклонённый запрос тоже расходует ёмкость тех вёдер, которые не переполнены
+                           (по умолчанию запрос либо списывается со всех вёдер, либо ни с одного)
+    :param chunk_size: кол-во наборов аргументов, обрабатываемых одним pipeline
+    :param cost: кол-во токенов, списываемых каждым запросом
+    """
+    if isinstance(rules, ThrottlingRule):
+        rules = [rules]
+    bundles = iter(bundles)
+    ret = []
+    while True:
+        groups = [BucketGroup(rules, bundle, options, key_template, cost)
+                  for bundle in islice(bundles, chunk_size)]
+        if not groups:
+            return ret
+        if not rules:
+            ret += [timedelta()] * len(groups)
+        elif any(isinstance(b, ScriptedThrottlingBucket) for b in groups[0].buckets):
+            ret += _evaluate_batch(groups, consume_denied)
+        else:
+            ret += _commit_batch(groups, consume_denied)
+
+
+def _check_local(buckets: BucketList, consume_denied: bool) -> timedelta:
+    """Проверяет вёдра по локальному кэшу и списывает запрос с арендованных вёдер (см. check_throttle)"""
+    if not consume_denied:
+        ret = local_throttle(buckets)
+        if ret:
+            return ret
+    else:
+        timeouts = [b.local_throttle() for b in buckets]
+        ret = _max_timeout(timeouts)
+        # вёдра, проверяемые скриптом, в пачке пропускаются, остальные сообщат об отказе в check_throttle()
+        for b, timeout in zip(buckets, timeouts):
+            if timeout and isinstance(b, ScriptedThrottlingBucket):
+                b._report(timeout)
+    leased = [b for b in buckets if isinstance(b, LeasedThrottlingBucket)]
+    ret = _max_timeout([ret] + [b.check_throttle() for b in leased])
+    if ret and not consume_denied:
+        for b in leased:
+            b.refund()
+    return ret
+
+
+def _commit_batch(groups: list, consume_denied: bool) -> List[timedelta]:
+    """
+    acquire_batch для вёдер без скриптов: состояние всех вёдер читается одним pipeline,
+    решения принимаются локально, а запись выполняется вторым pipeline.
+    Наборы с одинаковыми аргументами используют общее ведро, поэтому видят запросы друг друга.
+    """
+    options = groups[0].options
+    shared = {}
+    for g in groups:
+        g.buckets = [b if isinstance(b, SELF_COMMITTING) else shared.setdefault(b.base_key, b) for b in g.buckets]
+
+    pending = [b for b in shared.values() if b.cache_dict is None and not b.local_throttle()]
+    if pending:
+        pipe = options.redis.pipeline(transaction=False)
+        for b in pending:
+            pipe.hgetall(b.base_key)
+        for b, raw in zip(pending, pipe.execute()):
+            b.set_state(raw)
+
+    ret = []
+    pipe = options.redis.pipeline(options.transactions)
+    for g in groups:
+        timeout = _check_local(g.buckets, consume_denied)
+        if not timeout or consume_denied:
+            buckets = [b for b in g.buckets if not isinstance(b, SELF_COMMITTING)]
+            timeouts = [b.check_throttle() for b in buckets]
+            if any(timeouts) and not consume_denied:
+                for b in g.buckets:
+                    if isinstance(b, LeasedThrottlingBucket):
+                        b.refund()
+            for b, t in zip(buckets, timeouts):
+                if not t and (consume_denied or not any(timeouts)):
+                    b._commit(pipe, None)
+            timeout = _max_timeout([timeout] + timeouts)
+        ret.append(timeout)
+    if len(pipe):
+        pipe.execute()
+    return ret
+
+
+def _evaluate_batch(groups: list, consume_denied: bool) -> List[timedelta]:
+    """
+    acquire_batch для вёдер, проверяемых скриптом: вызовы CHECK_AND_COMMIT всех наборов аргументов
+    отправляются одним pipeline и исполняются Redis по порядку
+    """
+    options = groups[0].options
+    script = options.script(CHECK_AND_COMMIT)
+    pipe = options.redis.pipeline(transaction=False)
+    ret = []
+    calls = []
+    for i, g in enumerate(groups):
+        timeout = _check_local(g.buckets, consume_denied)
+        if not timeout or consume_denied:
+            buckets = [b for b in g.buckets if not isinstance(b, LeasedThrottlingBucket) and not b.local_throttle()]
+            for part in ([b] for b in buckets) if consume_denied else [buckets]:
+                if part:
+                    keys, args = ScriptedThrottlingBucket._script_arguments(part)
+                    script(keys=keys, args=args, client=pipe)
+                    calls.append((i, part))
+        ret.append(timeout)
+
+    for (i, part), result in zip(calls, pipe.execute() if calls else []):
+        ScriptedThrottlingBucket._apply_result(part, result)
+        ret[i] = _max_timeout([ret[i]] + [b.retry_after for b in part])
+    if not consume_denied:
+        for g, timeout in zip(groups, ret):
+            if timeout:
+                for b in g.buckets:
+                    if isinstance(b, LeasedThrottlingBucket):
+                        b.refund()
+    return ret
+
+
+class BucketGroup:
+    """
+    Вёдра всех правил для одного набора аргументов запроса, которые читаются и обновляются вместе:
+    состояние всех вёдер читается одним pipeline (или проверяется одним вызовом скрипта,
+    если включён ThrottlingOptions.use_script), а запись выполняется одной транзакцией.
+    Запрос либо списывается со всех вёдер, либо (если хоть одно переполнено) ни с одного.
+
+    Правила с разными ThrottlingRule.scope образуют иерархию квот (например, организация - пользователь):
+    запрос проверяется по всем уровням, а throttled_rules показывает, какие из них его отклонили.
+
+    acquire() резервирует токены до исполнения запроса: если запрос в итоге не исполнен (например, упал с ошибкой),
+    их можно вернуть через refund().
+    """
+
+    def __init__(self, rules: [RuleList, ThrottlingRule], arguments_bundle: dict, options: ThrottlingOptions=None,
+                 key_template: KeyTemplate=None, cost=1, request_buckets: dict=None, use_script: bool=None):
+        """
+        :param key_template: скомпилированный ключ для набора аргументов, если их имена известны заранее
+                             (используется для правил без scope)
+        :param cost: кол-во токенов, списываемых запросом с каждого ведра
+        :param request_buckets: вёдра, уже списанные в рамках того же запроса (base_key -> ведро), например
+                                middleware и ThrottledViewSetMixIn. Такие вёдра не проверяются и не списываются
+                                повторно, а вёдра этой группы добавляются в словарь после фиксации запроса.
+        :param use_script: проверять вёдра скриптом CHECK_AND_COMMIT независимо от ThrottlingOptions.use_script,
+                           чтобы проверка и списание были атомарны
+        """
+        if isinstance(rules, ThrottlingRule):
+            rules = [rules]
+        rules = rules or []
+        self.options = options or defaultThrottlingOptions
+        self.request_buckets = request_buckets
+        self.use_script = use_script
+        keys, hash_tag = _arguments_keys(rules, arguments_bundle, self.options, key_template)
+        self.buckets = []
+        self.pending = []
+        for rule, arguments_key in zip(rules, keys):
+            self._add(self._bucket_class(rule)(rule, arguments_bundle, self.options, arguments_key=arguments_key,
+                                               cost=cost, hash_tag=hash_tag))
+        self.timeout = None
+        self.committed = False
+
+    @classmethod
+    def from_buckets(cls, buckets: BucketList, request_buckets: dict=None):
+        """
+        Группа из уже созданных вёдер (например, get_buckets()), которые проверяются и списываются вместе.
+        Вёдра должны использовать одни и те же ThrottlingOptions.
+        """
+        group = cls([], {}, buckets[0].options if buckets else None, request_buckets=request_buckets)
+        for bucket in buckets:
+            group._add(bucket)
+        return group
+
+    def _add(self, bucket: ThrottlingBucket):
+        if self.request_buckets is not None and bucket.base_key in self.request_buckets:
+            bucket = self.request_buckets[bucket.base_key]
+        else:
+            self.pending.append(bucket)
+        self.buckets.append(bucket)
+
+    def __bool__(self):
+        return bool(self.buckets)
+
+    def _bucket_class(self, rule: ThrottlingRule):
+        return self.options.get_bucket_class(rule, self.use_script)
+
+    @property
+    def throttled_rules(self) -> RuleList:
+        """Правила, вёдра которых отклонили запрос при последней проверке"""
+        return [b.rule for b in self.buckets if b.timeout]
+
+    def rate_limit_headers(self) -> dict:
+        """HTTP-заголовки состояния лимита после проверки (см. utils.rate_limit_headers)"""
+        return rate_limit_headers(self.buckets, self.timeout)
+
+    def _load(self):
+        pending = [b for b in self.pending if b.cache_dict is None]
+        if not pending:
+            return
+        pipe = self.options.redis.pipeline(transaction=False)
+        for b in pending:
+            pipe.hgetall(b.base_key)
+        for b, raw in zip(pending, pipe.execute()):
+            b.set_state(raw)
+
+    def check_throttle(self) -> timedelta:
+        """Возвращает интервал, который осталось подождать до истечения таймаута вёдер"""
+        if self.timeout is None:
+            # переполненные по локальному кэшу вёдра не требуют чтения из хранилища
+            self.timeout = local_throttle(self.pending)
+            if not self.timeout:
+                self._load()
+                self.timeout = check_throttle(self.pending)
+        return self.timeout
+
+    def commit_request(self):
+        """Фиксирует запрос во всех вёдрах, если ни одно из них не переполнено"""
+        if self.check_throttle():
+            return
+        pipe = self.options.redis.pipeline(self.options.transactions)
+        for b in self.pending:
+            b.commit_request(pipe)
+        if len(pipe):
+            pipe.execute()
+        self._committed()
+
+    def _committed(self, committed=True):
+        """Отмечает, что запрос зафиксирован (или возвращён) в вёдрах группы, в том числе в request_buckets"""
+        self.committed = committed
+        if self.request_buckets is not None:
+            for b in self.pending:
+                if committed:
+                    self.request_buckets[b.base_key] = b
+                else:
+                    self.request_buckets.pop(b.base_key, None)
+
+    def refund(self):
+        """Возвращает в вёдра токены зафиксированного запроса"""
+        if self.committed:
+            refund_request(self.pending)
+            self._committed(False)
+
+    def acquire(self) -> timedelta:
+        """Проверяет вёдра и сразу фиксирует запрос, если лимит не превышен. Возвращает интервал ожидания"""
+        timeout = self.check_throttle()
+        if not timeout:
+            self.commit_request()
+        return timeout
+
+
+class AsyncBucketGroup(BucketGroup):
+    """Асинхронный вариант BucketGroup на вёдрах AsyncThrottlingBucket"""
+
+    def _bucket_class(self, rule: ThrottlingRule):
+        return self.options.get_async_bucket_class(rule, self.use_script)
+
+    async def _load(self):
+        pending = [b for b in self.pending if b.cache_dict is None]
+        if not pending:
+            return
+        pipe = self.options.async_redis.pipeline(transaction=False)
+        for b in pending:
+            pipe.hgetall(b.base_key)
+        for b, raw in zip(pending, await pipe.execute()):
+            b.set_state(raw)
+
+    async def check_throttle(self) -> timedelta:
+        if self.timeout is None:
+            self.timeout = local_throttle(self.pending)
+            if not self.timeout:
+                await self._load()
+                self.timeout = await async_check_throttle(self.pending)
+        return self.timeout
+
+    async def commit_request(self):
+        if await self.check_throttle():
+            return
+        pipe = self.options.async_redis.pipeline(self.options.transactions)
+        for b in self.pending:
+            await b.commit_request(pipe)
+        if len(pipe):
+            await pipe.execute()
+        self._committed()
+
+    async def refund(self):
+        if self.committed:
+            await async_refund_request(self.pending)
+            self._committed(False)
+
+    async def acquire(self) -> timedelta:
+        timeout = await self.check_throttle()
+        if not timeout:
+            await self.commit_request()
+        return timeout
@@ -0,0 +1,66 @@
+"""
+Replays an access log through throttling rules to check new limits against recorded traffic.
+
+Events are read from CSV (with a header) or JSONL, optionally gzipped, and must be ordered by time.
+Every event is one request (check_throttle + commit_request, as in bench.py) against an in-memory backend
+driven by a virtual clock, so decisions are the same as with redis without waiting for real time to pass:
+
+    python simulate.py access.jsonl --rule 100/60 --rule 1000/3600
+    python simulate.py access.csv.gz --rule 5/1 --rule gcra:100/60@org --arguments org,user --periods 1
+
+Rules are given as [algorithm:]max_requests/seconds[@scope,...], algorithm is bucket (default), gcra or window.
+The report (requests, throttle rates per rule and per key, peak bucket count) is printed as JSON.
+"""
+import argparse
+import json
+import sys
+
+from bucket_throttling import ThrottlingRule, GCRARule, SlidingWindowRule, KeyTemplate
+from bucket_throttling.simulation import Simulation, read_events
+
+RULE_CLASSES = {
+    'bucket': ThrottlingRule,
+    'gcra': GCRARule,
+    'window': SlidingWindowRule,
+}
+
+
+def parse_rule(spec: str) -> ThrottlingRule:
+    algorithm, _, value = spec.rpartition(':')
+    value, _, scope = value.partition('@')
+    max_requests, _, seconds = value.partition('/')
+    try:
+        rule_class = RULE_CLASSES[algorithm or 'bucket']
+        return rule_class(int(max_requests), float(seconds), scope=scope.split(',') if scope else None)
+    except (KeyError, ValueError):
+        raise argparse.ArgumentTypeError('expected [algorithm:]max_requests/seconds[@scope,...], got %r' % spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay an access log through throttling rules')
+    parser.add_argument('log', help='CSV or JSONL file (.gz is decompressed)')
+    parser.add_argument('--rule', type=parse_rule, action='append', required=True,
+                        help='[algorithm:]max_requests/seconds[@scope,...], may be repeated')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='log format (default by file extension)')
+    parser.add_argument('--timestamp-field', default='timestamp', help='unix timestamp or ISO 8601 date field')
+    parser.add_argument('--arguments', type=lambda v: v.split(','),
+                        help='comma separated fields of throttling arguments (default all but timestamp)')
+    parser.add_argument('--periods', type=int, default=0, help='periods_to_overtake')
+    parser.add_argument('--use-script', action='store_true', help='check buckets with CHECK_AND_COMMIT script')
+    parser.add_argument('--purge-interval', type=float, default=60,
+                        help='seconds of log time between counts of live buckets')
+    parser.add_argument('--trace-memory', action='store_true', help='measure peak memory (several times slower)')
+    parser.add_argument('--top', type=int, default=10, help='keys with most throttled requests to report')
+    args = parser.parse_args()
+
+    simulation = Simulation(args.rule, periods_to_overtake=args.periods, use_script=args.use_script,
+                            key_template=KeyTemplate(*args.arguments) if args.arguments else None,
+                            purge_interval=args.purge_interval, trace_memory=args.trace_memory)
+    events = read_events(args.log, args.timestamp_field, args.arguments, args.format)
+    report = simulation.run(events)
+    json.dump(report.as_dict(args.top), sys.stdout, indent=2, ensure_ascii=False)
+    print()
+
+
+if __name__ == '__main__':
+    main()
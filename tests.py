@@ -1,8 +1,23 @@
+import asyncio
+import importlib.util
+import json
+import os
+import tempfile
 import unittest
 import time
 
 from bucket_throttling.utils import *
-from bucket_throttling import ThrottlingOptions
+from bucket_throttling import connections, ThrottlingOptions, GCRARule, SlidingWindowRule, KeyTemplate, build_cache_key
+from bucket_throttling.backends import MemoryBackend, ShardedBackend
+from bucket_throttling.breaker import CircuitBreaker
+from bucket_throttling.cache import ThrottledCache
+from bucket_throttling.integrations.python import throttled
+from bucket_throttling.lease import LeaseStore
+from bucket_throttling.metrics import Metrics
+from bucket_throttling.simulation import Simulation, read_events
+
+# THROTTLING_TEST_BACKEND=memory runs tests without redis server
+TEST_BACKEND = MemoryBackend() if os.environ.get('THROTTLING_TEST_BACKEND') == 'memory' else None
 
 
 def try_request(rules: list, options, request_arguments: dict, delay_after: float, expected_result: bool):
@@ -17,13 +32,19 @@ def try_request(rules: list, options, request_arguments: dict, delay_after: floa
     time.sleep(delay_after)
 
 
+def clear_buckets(rules: list, arguments: dict, options=None):
+    """Deletes buckets left by a previous run, for tests with long intervals to pass when rerun at once"""
+    options = options or ThrottlingOptions(backend=TEST_BACKEND)
+    options.redis.delete(*[b.base_key for b in get_buckets(rules, arguments, options)])
+
+
 class MultipleUserTest(unittest.TestCase):
     TEST_RULES = [
         ThrottlingRule(max_requests=1, interval=timedelta(seconds=1)),
         ThrottlingRule(max_requests=2, interval=timedelta(seconds=5)),
     ]
 
-    TEST_OPTIONS = ThrottlingOptions(verbose_mode=True, periods_to_overtake=0)
+    TEST_OPTIONS = ThrottlingOptions(verbose_mode=True, periods_to_overtake=0, backend=TEST_BACKEND)
 
     def __init__(self, methodName='runTest'):
         super().__init__(methodName)
@@ -50,7 +71,8 @@ class BurstTest(unittest.TestCase):
         ThrottlingRule(max_requests=30, interval=timedelta(seconds=3)),
     ]
 
-    TEST_OPTIONS = ThrottlingOptions(verbose_mode=True, periods_to_overtake=1)  # , redis_options={'port': 6363}
+    TEST_OPTIONS = ThrottlingOptions(verbose_mode=True, periods_to_overtake=1,
+                                     backend=TEST_BACKEND)  # , redis_options={'port': 6363}
 
     def __init__(self, methodName='runTest'):
         super().__init__(methodName)
@@ -70,5 +92,753 @@ class BurstTest(unittest.TestCase):
         self.burst_test(1, self.TEST_RULES, self.TEST_OPTIONS)
 
 
+class ScriptTest(unittest.TestCase):
+    TEST_OPTIONS = ThrottlingOptions(verbose_mode=True, periods_to_overtake=0, use_script=True,
+                                     backend=TEST_BACKEND)
+
+    def test_users(self):
+        MultipleUserTest.user_test(3, MultipleUserTest.TEST_RULES, self.TEST_OPTIONS)
+
+    def test_all_or_nothing(self):
+        rules = [
+            ThrottlingRule(max_requests=5, interval=timedelta(seconds=5)),
+            ThrottlingRule(max_requests=1, interval=timedelta(seconds=5)),
+        ]
+        try_request(rules, self.TEST_OPTIONS, dict(path='path4'), 0, True)
+        try_request(rules, self.TEST_OPTIONS, dict(path='path4'), 0, False)
+        # throttled request must not be charged from the first bucket (5 - first request - this check)
+        buckets = get_buckets(rules[:1], dict(path='path4'), self.TEST_OPTIONS)
+        check_throttle(buckets)
+        self.assertEqual(buckets[0].remaining, 3)
+
+
+class BucketGroupTest(unittest.TestCase):
+    TEST_RULES = [
+        ThrottlingRule(max_requests=5, interval=timedelta(seconds=5)),
+        ThrottlingRule(max_requests=2, interval=timedelta(seconds=5)),
+    ]
+
+    def group_test(self, options, path):
+        arguments = dict(path=path)
+        self.assertFalse(BucketGroup(self.TEST_RULES, arguments, options).acquire())
+        self.assertFalse(BucketGroup(self.TEST_RULES, arguments, options).acquire())
+        self.assertTrue(BucketGroup(self.TEST_RULES, arguments, options).acquire())
+
+    def test_pipeline(self):
+        self.group_test(ThrottlingOptions(verbose_mode=True, backend=TEST_BACKEND), 'path5')
+        # throttled request is not charged from the first bucket
+        buckets = get_buckets(self.TEST_RULES[:1], dict(path='path5'), ThrottlingOptions(backend=TEST_BACKEND))
+        self.assertEqual(buckets[0]._capacity, 3)
+
+    def test_script(self):
+        self.group_test(ThrottlingOptions(verbose_mode=True, use_script=True, backend=TEST_BACKEND), 'path6')
+
+
+class AsyncTest(unittest.TestCase):
+    TEST_RULES = [
+        ThrottlingRule(max_requests=2, interval=timedelta(seconds=5)),
+    ]
+
+    async def async_test(self, options, path):
+        arguments = dict(path=path)
+        self.assertFalse(await AsyncBucketGroup(self.TEST_RULES, arguments, options).acquire())
+
+        buckets = await async_get_buckets(self.TEST_RULES, arguments, options)
+        self.assertFalse(await async_check_throttle(buckets))
+        await async_commit_request(buckets)
+
+        self.assertTrue(await AsyncBucketGroup(self.TEST_RULES, arguments, options).acquire())
+
+    def test_pipeline(self):
+        asyncio.run(self.async_test(ThrottlingOptions(verbose_mode=True, backend=TEST_BACKEND), 'path7'))
+
+    def test_script(self):
+        options = ThrottlingOptions(verbose_mode=True, use_script=True, backend=TEST_BACKEND)
+        asyncio.run(self.async_test(options, 'path8'))
+
+
+class MemoryBackendTest(unittest.TestCase):
+    TEST_RULES = [
+        ThrottlingRule(max_requests=2, interval=timedelta(seconds=5)),
+    ]
+
+    def test_multiple_users(self):
+        options = ThrottlingOptions(backend=MemoryBackend())
+        MultipleUserTest.user_test(1, MultipleUserTest.TEST_RULES, options)
+        MultipleUserTest.user_test(1, MultipleUserTest.TEST_RULES, ThrottlingOptions(backend=MemoryBackend(),
+                                                                                     use_script=True))
+
+    def test_expire(self):
+        now = [0]
+        backend = MemoryBackend(clock=lambda: now[0])
+        backend.hset('key', 'capacity', 1)
+        backend.expire('key', 10)
+        self.assertEqual(backend.hgetall('key'), {b'capacity': 1})
+        now[0] = 10
+        self.assertEqual(backend.hgetall('key'), {})
+
+    def test_max_size(self):
+        backend = MemoryBackend(max_size=4, shards=1)
+        options = ThrottlingOptions(backend=backend)
+        for user_id in range(10):
+            BucketGroup(self.TEST_RULES, dict(user=user_id), options).acquire()
+        self.assertEqual(len(backend), 4)
+
+
+class ThrottledCacheTest(unittest.TestCase):
+    TEST_RULES = [
+        ThrottlingRule(max_requests=1, interval=timedelta(seconds=1)),
+    ]
+
+    def cache_test(self, options, path):
+        arguments = dict(path=path)
+        self.assertFalse(BucketGroup(self.TEST_RULES, arguments, options).acquire())
+        self.assertTrue(BucketGroup(self.TEST_RULES, arguments, options).acquire())
+        self.assertEqual(len(options.throttled_cache), 1)
+
+        # throttled locally, storage is not read
+        group = BucketGroup(self.TEST_RULES, arguments, options)
+        self.assertTrue(group.acquire())
+        self.assertIsNone(group.buckets[0].cache_dict)
+
+        time.sleep(1)
+        self.assertFalse(BucketGroup(self.TEST_RULES, arguments, options).acquire())
+
+    def test_pipeline(self):
+        self.cache_test(ThrottlingOptions(backend=TEST_BACKEND, throttled_cache=ThrottledCache()), 'path9')
+
+    def test_max_size(self):
+        cache = ThrottledCache(max_size=2)
+        for key in range(5):
+            cache.set(key, timedelta(seconds=10))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(0))
+        self.assertTrue(cache.get(4))
+
+
+class LeaseTest(unittest.TestCase):
+    TEST_RULES = [
+        ThrottlingRule(max_requests=10, interval=timedelta(seconds=5), lease_size=4),
+    ]
+
+    def lease_test(self, backend, path):
+        # two processes sharing the same bucket
+        options1 = ThrottlingOptions(verbose_mode=True, backend=backend)
+        options2 = ThrottlingOptions(verbose_mode=True, backend=backend)
+        arguments = dict(path=path)
+
+        self.assertFalse(BucketGroup(self.TEST_RULES, arguments, options1).acquire())
+        for i in range(6):
+            self.assertFalse(BucketGroup(self.TEST_RULES, arguments, options2).acquire())
+        self.assertTrue(BucketGroup(self.TEST_RULES, arguments, options2).acquire())
+
+        # unused tokens of the first process are returned to the bucket
+        options1.return_leases()
+        for i in range(3):
+            self.assertFalse(BucketGroup(self.TEST_RULES, arguments, options2).acquire())
+        self.assertTrue(BucketGroup(self.TEST_RULES, arguments, options2).acquire())
+
+    def test_lease(self):
+        self.lease_test(TEST_BACKEND, 'path10')
+
+    def test_memory_backend(self):
+        self.lease_test(MemoryBackend(), 'path10')
+
+    def test_refund(self):
+        options = ThrottlingOptions(backend=MemoryBackend())
+        rules = self.TEST_RULES + [ThrottlingRule(max_requests=1, interval=timedelta(seconds=5))]
+        self.assertFalse(BucketGroup(rules, dict(path='path11'), options).acquire())
+        group = BucketGroup(rules, dict(path='path11'), options)
+        self.assertTrue(group.acquire())
+        # the token taken from the lease is returned, since the second rule throttled
+        self.assertEqual(options.leases.leases[group.buckets[0].base_key].tokens, 3)
+
+    def test_refill(self):
+        now = [1000000.0]
+        backend = MemoryBackend(clock=lambda: now[0])
+        options1, options2 = [ThrottlingOptions(backend=backend, clock=lambda: now[0]) for i in range(2)]
+        for options in (options1, options2):
+            options.lease_store = LeaseStore(clock=lambda: now[0])
+        rule = ThrottlingRule(max_requests=10, interval=timedelta(seconds=60), lease_size=5)
+        arguments = dict(path='path46')
+        self.assertFalse(BucketGroup([rule], arguments, options2).acquire())
+        now[0] += 50
+        # the lease is taken 10 seconds before the bucket refill and expires with it
+        self.assertFalse(BucketGroup([rule], arguments, options1).acquire())
+        key = BucketGroup([rule], arguments, options1).buckets[0].base_key
+        self.assertEqual(options1.leases.leases[key].expires_at, 1000060.0)
+        self.assertEqual(int(backend.hgetall(key)[b'capacity']), 0)
+        now[0] += 11
+        self.assertFalse(BucketGroup([rule], arguments, options1).acquire())
+        self.assertEqual(int(backend.hgetall(key)[b'capacity']), 5)
+
+
+class AlgorithmTest(unittest.TestCase):
+
+    def gcra_test(self, options, path):
+        rules = [GCRARule(max_requests=4, interval=timedelta(seconds=2))]
+        for i in range(4):
+            try_request(rules, options, dict(path=path), 0, True)
+        buckets = get_buckets(rules, dict(path=path), options)
+        timeout = check_throttle(buckets)
+        self.assertTrue(timedelta(seconds=0.4) < timeout <= timedelta(seconds=0.5))
+        # one request per 0.5 second
+        time.sleep(timeout.total_seconds())
+        try_request(rules, options, dict(path=path), 0, True)
+        try_request(rules, options, dict(path=path), 0, False)
+
+    def window_test(self, options, path):
+        rules = [SlidingWindowRule(max_requests=4, interval=timedelta(seconds=2))]
+        for i in range(4):
+            try_request(rules, options, dict(path=path), 0, True)
+        buckets = get_buckets(rules, dict(path=path), options)
+        timeout = check_throttle(buckets)
+        self.assertTrue(timedelta() < timeout <= timedelta(seconds=4))
+        time.sleep(timeout.total_seconds())
+        try_request(rules, options, dict(path=path), 0, True)
+
+    def test_gcra(self):
+        self.gcra_test(ThrottlingOptions(verbose_mode=True, backend=TEST_BACKEND), 'path12')
+        self.gcra_test(ThrottlingOptions(verbose_mode=True, backend=MemoryBackend()), 'path12')
+
+    def test_window(self):
+        self.window_test(ThrottlingOptions(verbose_mode=True, backend=TEST_BACKEND), 'path13')
+        self.window_test(ThrottlingOptions(verbose_mode=True, backend=MemoryBackend()), 'path13')
+
+    def test_mixed_rules(self):
+        options = ThrottlingOptions(verbose_mode=True, backend=TEST_BACKEND)
+        rules = [
+            GCRARule(max_requests=10, interval=timedelta(seconds=5)),
+            ThrottlingRule(max_requests=1, interval=timedelta(seconds=5)),
+        ]
+        try_request(rules, options, dict(path='path14'), 0, True)
+        try_request(rules, options, dict(path='path14'), 0, False)
+        # request throttled by the token bucket is not charged from GCRA rule
+        buckets = get_buckets(rules[:1], dict(path='path14'), options)
+        check_throttle(buckets)
+        self.assertEqual(buckets[0].remaining, 8)
+
+
+class KeyTest(unittest.TestCase):
+
+    def test_key_template(self):
+        arguments = dict(user='vasya man', view='view', method='GET')
+        template = KeyTemplate('view', 'user', 'method')
+        self.assertEqual(template.build(arguments), build_cache_key(**arguments))
+
+    def test_hashed_keys(self):
+        options = ThrottlingOptions(backend=TEST_BACKEND, hashed_keys=True)
+        rules = [ThrottlingRule(max_requests=1, interval=timedelta(seconds=5))]
+        arguments = dict(path='path15', payload='x' * 1000)
+        group = BucketGroup(rules, arguments, options)
+        self.assertFalse(group.acquire())
+        self.assertEqual(len(group.buckets[0].base_key), len('THROTTLING:') + len(rules[0].cache_key) + 32)
+        self.assertTrue(BucketGroup(rules, arguments, options).acquire())
+
+
+class ShardedBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = [MemoryBackend(), MemoryBackend()]
+        self.options = ThrottlingOptions(backend=ShardedBackend(clients=self.nodes))
+        self.rules = [ThrottlingRule(max_requests=2, interval=timedelta(seconds=5)),
+                      GCRARule(max_requests=3, interval=timedelta(seconds=5))]
+
+    def test_hash_tags(self):
+        arguments = dict(path='path16')
+        buckets = get_buckets(self.rules, arguments, self.options)
+        self.assertTrue(all(b.base_key.startswith('THROTTLING:{path;path16}') for b in buckets))
+        self.assertEqual(len({self.options.redis.node_index(b.base_key) for b in buckets}), 1)
+
+    def test_script(self):
+        arguments = dict(path='path17')
+        for i in range(2):
+            self.assertFalse(BucketGroup(self.rules, arguments, self.options).acquire())
+        self.assertTrue(BucketGroup(self.rules, arguments, self.options).acquire())
+
+    def test_distribution(self):
+        rules = self.rules[:1]
+        for i in range(50):
+            self.assertFalse(BucketGroup(rules, dict(path='path18', user=i), self.options).acquire())
+        self.assertTrue(all(len(node) > 0 for node in self.nodes))
+
+
+class BatchTest(unittest.TestCase):
+
+    def batch(self, use_script, path):
+        options = ThrottlingOptions(backend=TEST_BACKEND, use_script=use_script)
+        rules = [ThrottlingRule(max_requests=3, interval=timedelta(seconds=5))]
+        bundles = [dict(path=path, user=1)] * 5 + [dict(path=path, user=2)]
+        result = [bool(t) for t in acquire_batch(rules, bundles, options, chunk_size=4)]
+        self.assertEqual(result, [False, False, False, True, True, False])
+        self.assertTrue(BucketGroup(rules, bundles[0], options).acquire())
+
+    def test_batch(self):
+        self.batch(False, 'path19')
+
+    def test_script(self):
+        self.batch(True, 'path20')
+
+    def consume_denied(self, use_script, path):
+        options = ThrottlingOptions(backend=TEST_BACKEND, use_script=use_script)
+        strict = ThrottlingRule(max_requests=1, interval=timedelta(seconds=5))
+        loose = ThrottlingRule(max_requests=3, interval=timedelta(seconds=5))
+        for consume_denied, expected in ((False, [False, False]), (True, [True])):
+            arguments = dict(path=path, consume_denied=consume_denied)
+            result = acquire_batch([strict, loose], [arguments] * 3, options, consume_denied=consume_denied)
+            self.assertEqual([bool(t) for t in result], [False, True, True])
+            self.assertEqual([bool(BucketGroup(loose, arguments, options).acquire()) for i in expected], expected)
+
+    def test_consume_denied(self):
+        self.consume_denied(False, 'path21')
+
+    def test_script_consume_denied(self):
+        self.consume_denied(True, 'path22')
+
+
+class RecordingMetrics(Metrics):
+
+    def __init__(self):
+        self.decisions = []
+        self.events = []
+        self.operations = []
+
+    def decision(self, rule, key, timeout):
+        self.decisions.append(bool(timeout))
+
+    def bucket_event(self, rule, key, event, capacity):
+        self.events.append((event, capacity))
+
+    def latency(self, operation, seconds):
+        self.operations.append(operation)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_bucket(self):
+        metrics = RecordingMetrics()
+        options = ThrottlingOptions(backend=TEST_BACKEND, metrics=metrics)
+        rules = [ThrottlingRule(max_requests=2, interval=timedelta(seconds=5))]
+        for i in range(3):
+            BucketGroup(rules, dict(path='path23'), options).acquire()
+        self.assertEqual(metrics.decisions, [False, False, True])
+        self.assertEqual(metrics.events, [('create', 1), ('spend', 0)])
+        self.assertEqual(set(metrics.operations), {'pipeline'})
+
+    def test_script(self):
+        metrics = RecordingMetrics()
+        options = ThrottlingOptions(backend=TEST_BACKEND, metrics=metrics, use_script=True)
+        rules = [ThrottlingRule(max_requests=2, interval=timedelta(seconds=5))]
+        for i in range(3):
+            BucketGroup(rules, dict(path='path24'), options).acquire()
+        self.assertEqual(metrics.decisions, [False, False, True])
+        self.assertEqual(metrics.events, [('spend', 1), ('spend', 0)])
+        self.assertEqual(metrics.operations, ['check_and_commit'] * 3)
+
+
+class UnavailableBackend(MemoryBackend):
+    available = False
+
+    def _check(self):
+        if not self.available:
+            raise ConnectionError('storage is unavailable')
+
+    def hgetall(self, key):
+        self._check()
+        return super().hgetall(key)
+
+    def ping(self):
+        self._check()
+        return True
+
+    def register_script(self, script):
+        call = super().register_script(script)
+
+        def checked(keys=(), args=(), client=None):
+            self._check()
+            return call(keys, args, client)
+        return checked
+
+
+class BreakerTest(unittest.TestCase):
+    rules = [ThrottlingRule(max_requests=2, interval=timedelta(seconds=5))]
+
+    def acquire(self, fallback, use_script=False) -> list:
+        breaker = CircuitBreaker(fallback, failure_threshold=1, probe_interval=0.1)
+        options = ThrottlingOptions(backend=UnavailableBackend(), use_script=use_script, breaker=breaker)
+        return [bool(BucketGroup(self.rules, dict(path='path25'), options).acquire()) for i in range(3)]
+
+    def test_fallback(self):
+        for use_script in (False, True):
+            self.assertEqual(self.acquire('open', use_script), [False, False, False])
+            self.assertEqual(self.acquire('closed', use_script), [True, True, True])
+            self.assertEqual(self.acquire('local', use_script), [False, False, True])
+
+    def test_recovery(self):
+        backend = UnavailableBackend()
+        breaker = CircuitBreaker('closed', failure_threshold=2, probe_interval=0.1)
+        options = ThrottlingOptions(backend=backend, breaker=breaker)
+        for i in range(2):
+            self.assertTrue(BucketGroup(self.rules, dict(path='path26'), options).acquire())
+        self.assertTrue(breaker.tripped)
+        backend.available = True
+        time.sleep(0.3)
+        self.assertFalse(breaker.tripped)
+        self.assertFalse(BucketGroup(self.rules, dict(path='path26'), options).acquire())
+
+    def test_async(self):
+        breaker = CircuitBreaker('local', failure_threshold=1)
+        options = ThrottlingOptions(backend=UnavailableBackend(), breaker=breaker)
+
+        async def acquire():
+            return [bool(await AsyncBucketGroup(self.rules, dict(path='path27'), options).acquire()) for i in range(3)]
+        self.assertEqual(asyncio.run(acquire()), [False, False, True])
+
+
+class ClockTest(unittest.TestCase):
+    rules = [ThrottlingRule(max_requests=2, interval=timedelta(seconds=5))]
+
+    def test_clock(self):
+        now = [1000000.0]
+        options = ThrottlingOptions(backend=MemoryBackend(clock=lambda: now[0]), clock=lambda: now[0])
+        results = []
+        for step in (0, 1, 1, 4, 0, 0):
+            now[0] += step
+            results.append(BucketGroup(self.rules, dict(path='path28'), options).acquire())
+        self.assertEqual([bool(t) for t in results], [False, False, True, False, False, True])
+        self.assertEqual(results[2], timedelta(seconds=3))
+
+    def test_server_time(self):
+        options = ThrottlingOptions(backend=TEST_BACKEND, use_script=True, server_time=True, clock=lambda: 0)
+        rules = self.rules + [GCRARule(max_requests=3, interval=timedelta(seconds=5))]
+        results = [bool(BucketGroup(rules, dict(path='path29'), options).acquire()) for i in range(3)]
+        self.assertEqual(results, [False, False, True])
+
+
+class CostTest(unittest.TestCase):
+
+    def test_cost(self):
+        rules = [ThrottlingRule(max_requests=5, interval=timedelta(seconds=60))]
+        for use_script in (False, True):
+            options = ThrottlingOptions(backend=TEST_BACKEND, use_script=use_script)
+            arguments = dict(path='path30', script=use_script)
+            clear_buckets(rules, arguments)
+            results = [bool(BucketGroup(rules, arguments, options, cost=cost).acquire()) for cost in (2, 2, 2, 1, 6)]
+            self.assertEqual(results, [False, False, True, False, True])
+
+    def test_algorithms(self):
+        options = ThrottlingOptions(backend=TEST_BACKEND)
+        for rule in (GCRARule(max_requests=5, interval=timedelta(seconds=60)),
+                     SlidingWindowRule(max_requests=5, interval=timedelta(seconds=60)),
+                     ThrottlingRule(max_requests=5, interval=timedelta(seconds=60), lease_size=2)):
+            arguments = dict(path='path31', algorithm=rule.algorithm, lease=rule.lease_size)
+            clear_buckets([rule], arguments)
+            results = [bool(BucketGroup([rule], arguments, options, cost=cost).acquire()) for cost in (3, 2, 1)]
+            self.assertEqual(results, [False, False, True])
+
+    def test_oversized_cost(self):
+        for use_script in (False, True):
+            options = ThrottlingOptions(backend=TEST_BACKEND, use_script=use_script)
+            for rule in (ThrottlingRule(max_requests=5, interval=timedelta(seconds=60)),
+                         GCRARule(max_requests=5, interval=timedelta(seconds=60)),
+                         SlidingWindowRule(max_requests=5, interval=timedelta(seconds=60)),
+                         ThrottlingRule(max_requests=5, interval=timedelta(seconds=60), lease_size=2)):
+                arguments = dict(path='path45', algorithm=rule.algorithm, lease=rule.lease_size, script=use_script)
+                clear_buckets([rule], arguments)
+                # a request costing more than the bucket holds is throttled for the whole interval
+                self.assertEqual(BucketGroup([rule], arguments, options, cost=6).acquire(), timedelta(seconds=60))
+                self.assertFalse(BucketGroup([rule], arguments, options, cost=5).acquire())
+
+    def test_throttled_cache(self):
+        rules = [ThrottlingRule(max_requests=5, interval=timedelta(seconds=60))]
+        for use_script in (False, True):
+            options = ThrottlingOptions(backend=TEST_BACKEND, use_script=use_script, throttled_cache=ThrottledCache())
+            arguments = dict(path='path41', script=use_script)
+            clear_buckets(rules, arguments)
+            # a denied expensive request must not block cheaper ones while tokens remain
+            results = [bool(BucketGroup(rules, arguments, options, cost=cost).acquire()) for cost in (3, 3, 1, 1, 1)]
+            self.assertEqual(results, [False, True, False, False, True])
+            self.assertTrue(options.throttled_cache.get(BucketGroup(rules, arguments, options).buckets[0].base_key))
+
+
+class ScopeTest(unittest.TestCase):
+    rules = [ThrottlingRule(max_requests=3, interval=timedelta(seconds=60), scope=['org']),
+             ThrottlingRule(max_requests=2, interval=timedelta(seconds=60), scope=['org', 'user'])]
+
+    def test_hierarchy(self):
+        for use_script in (False, True):
+            options = ThrottlingOptions(backend=TEST_BACKEND, use_script=use_script)
+            org = 'org32-%s' % use_script
+            for user in (1, 2):
+                clear_buckets(self.rules, dict(org=org, user=user))
+            for i in range(2):
+                self.assertFalse(BucketGroup(self.rules, dict(org=org, user=1, view=i), options).acquire())
+            group = BucketGroup(self.rules, dict(org=org, user=1), options)
+            self.assertTrue(group.acquire())
+            self.assertEqual(group.throttled_rules, self.rules[1:])
+
+            self.assertFalse(BucketGroup(self.rules, dict(org=org, user=2), options).acquire())
+            group = BucketGroup(self.rules, dict(org=org, user=2), options)
+            self.assertTrue(group.acquire())
+            self.assertEqual(group.throttled_rules, self.rules[:1])
+
+    def test_hash_tags(self):
+        options = ThrottlingOptions(backend=ShardedBackend(clients=[MemoryBackend(), MemoryBackend()]))
+        rules = self.rules + [ThrottlingRule(max_requests=1, interval=timedelta(seconds=60))]
+        buckets = get_buckets(rules, dict(org='org33', user=1, view='view'), options)
+        self.assertTrue(all(b.base_key.startswith('THROTTLING:{org;org33}') for b in buckets))
+        self.assertEqual(len({b.base_key for b in buckets}), 3)
+        self.assertFalse(BucketGroup(rules, dict(org='org33', user=1, view='view'), options).acquire())
+
+
+class ReserveTest(unittest.TestCase):
+    rules = [ThrottlingRule(max_requests=2, interval=timedelta(seconds=60))]
+
+    def test_refund(self):
+        for use_script in (False, True):
+            options = ThrottlingOptions(backend=TEST_BACKEND, use_script=use_script)
+            clear_buckets(self.rules, dict(path='path34', script=use_script))
+
+            @throttled(self.rules, lambda fail: dict(path='path34', script=use_script), options, reserve=True,
+                       refund_on_error=True, on_throttled=lambda group: group.timeout)
+            def func(fail):
+                if fail:
+                    raise ValueError()
+                return 'ok'
+
+            for i in range(3):
+                self.assertRaises(ValueError, func, True)
+            self.assertEqual([func(False), func(False)], ['ok', 'ok'])
+            self.assertIsInstance(func(False), timedelta)
+
+    def test_interleaved(self):
+        options = ThrottlingOptions(backend=TEST_BACKEND)
+        arguments = dict(path='path39')
+        for path in ('path39', 'path40'):
+            clear_buckets(self.rules, dict(path=path))
+        # reads of all groups happen before any write, as with concurrent requests
+        groups = [BucketGroup(self.rules, arguments, options, use_script=True) for i in range(4)]
+        for group in groups:
+            group._load()
+        self.assertEqual([bool(group.acquire()) for group in groups], [False, False, True, True])
+
+        @throttled(self.rules, lambda: dict(path='path40'), options, reserve=True, on_throttled=lambda group: group)
+        def func():
+            return 'ok'
+
+        self.assertEqual([func(), func()], ['ok', 'ok'])
+        self.assertIsInstance(func().buckets[0], ScriptedThrottlingBucket)
+
+    def test_refund_algorithms(self):
+        options = ThrottlingOptions(backend=TEST_BACKEND)
+        for rule in (GCRARule(max_requests=2, interval=timedelta(seconds=60)),
+                     SlidingWindowRule(max_requests=2, interval=timedelta(seconds=60))):
+            arguments = dict(path='path35', algorithm=rule.algorithm)
+            clear_buckets([rule], arguments)
+            group = BucketGroup([rule], arguments, options)
+            self.assertFalse(group.acquire())
+            group.refund()
+            results = [bool(BucketGroup([rule], arguments, options).acquire()) for i in range(3)]
+            self.assertEqual(results, [False, False, True])
+
+    def test_headers(self):
+        for use_script in (False, True):
+            options = ThrottlingOptions(backend=TEST_BACKEND, use_script=use_script)
+            arguments = dict(path='path36', script=use_script)
+            clear_buckets(self.rules, arguments)
+            group = BucketGroup(self.rules, arguments, options)
+            self.assertFalse(group.acquire())
+            self.assertEqual(group.rate_limit_headers(),
+                             {'X-RateLimit-Limit': '2', 'X-RateLimit-Remaining': '1', 'X-RateLimit-Reset': '60'})
+            BucketGroup(self.rules, arguments, options).acquire()
+            group = BucketGroup(self.rules, arguments, options)
+            self.assertTrue(group.acquire())
+            headers = group.rate_limit_headers()
+            self.assertEqual(headers['X-RateLimit-Remaining'], '0')
+            self.assertEqual(headers['Retry-After'], '60')
+
+
+class DjangoTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from django.conf import settings
+        if not settings.configured:
+            settings.configure(SECRET_KEY='test', USE_I18N=True, INSTALLED_APPS=[
+                'django.contrib.contenttypes', 'django.contrib.auth'])
+            import django
+            django.setup()
+
+    def test_render_cache(self):
+        from django.utils import translation
+        from bucket_throttling.integrations.django import HttpResponseThrottled, _render_detail
+        _render_detail.cache_clear()
+        for language in ('en', 'ru', 'en'):
+            with translation.override(language):
+                for seconds in (59.5, 59.9, 30):
+                    HttpResponseThrottled.render_detail(timedelta(seconds=seconds))
+        # 59.5 and 59.9 seconds are rendered alike, so two entries per language
+        info = _render_detail.cache_info()
+        self.assertEqual((info.currsize, info.hits), (4, 5))
+
+    def test_retry_after(self):
+        from bucket_throttling.integrations.django import HttpResponseThrottled
+        response = HttpResponseThrottled(timedelta(seconds=59.5))
+        self.assertEqual(response['Retry-After'], '60')
+        # the text is rounded the same way as the header
+        self.assertEqual(json.loads(response.content),
+                         {'detail': HttpResponseThrottled.render_detail(timedelta(seconds=60))[0]})
+
+        class MachineReadableThrottled(HttpResponseThrottled):
+            machine_readable = True
+
+        response = MachineReadableThrottled(timedelta(seconds=59.5))
+        self.assertEqual(json.loads(response.content), {'retry_after': 60})
+        self.assertEqual(response['Retry-After'], '60')
+
+    @unittest.skipUnless(importlib.util.find_spec('rest_framework'), 'rest_framework is not installed')
+    def test_rest_framework(self):
+        from rest_framework.test import APIRequestFactory
+        from rest_framework.views import APIView
+        from rest_framework.response import Response
+        from bucket_throttling.integrations.rest_framework import ThrottledViewSetMixIn, ThrottledException
+
+        exception = ThrottledException(timedelta(seconds=59.5), machine_readable=True)
+        self.assertEqual((exception.detail, exception.wait), ({'retry_after': 60}, 60))
+
+        class View(ThrottledViewSetMixIn, APIView):
+            throttling_rules = [ThrottlingRule(max_requests=1, interval=timedelta(seconds=60))]
+            throttling_machine_readable = True
+            authentication_classes = []
+            permission_classes = []
+
+            def get_throttling_buckets(self, request):
+                return get_buckets(self.throttling_rules, dict(path='path44'), ThrottlingOptions(backend=TEST_BACKEND))
+
+            def get(self, request):
+                return Response({'ok': 1})
+
+        clear_buckets(View.throttling_rules, dict(path='path44'))
+        view = View.as_view()
+        responses = [view(APIRequestFactory().get('/')) for i in range(2)]
+        self.assertEqual([r.status_code for r in responses], [200, 429])
+        self.assertEqual(responses[1].data, {'retry_after': 60})
+        self.assertEqual(responses[1]['Retry-After'], '60')
+
+
+class ConnectionsTest(unittest.TestCase):
+    redis_options = dict(host='localhost', db=14)
+
+    def setUp(self):
+        # fork tests call connections._after_fork(), other tests keep using clients of this process
+        self.connections = connections.generation, dict(connections._clients), connections._lock
+
+    def tearDown(self):
+        connections.generation, clients, connections._lock = self.connections
+        connections._clients.clear()
+        connections._clients.update(clients)
+
+    def test_shared_client(self):
+        options = ThrottlingOptions(redis_options=self.redis_options, max_connections=5, health_check_interval=30)
+        self.assertIs(options.storage, ThrottlingOptions(redis_options=dict(self.redis_options), max_connections=5,
+                                                         health_check_interval=30).storage)
+        self.assertIsNot(options.storage, ThrottlingOptions(redis_options=self.redis_options).storage)
+        self.assertEqual(options.storage.connection_pool.max_connections, 5)
+        self.assertEqual(options.storage.connection_pool.connection_kwargs['health_check_interval'], 30)
+
+    def test_fork(self):
+        options = ThrottlingOptions(redis_options=self.redis_options, metrics=Metrics())
+        client, wrapped, leases = options.storage, options.redis, options.leases
+        connections._after_fork()
+        self.assertIsNot(options.storage, client)
+        self.assertIsNot(options.redis, wrapped)
+        self.assertIsNot(options.leases, leases)
+        self.assertIs(ThrottlingOptions(redis_options=self.redis_options).storage, options.storage)
+
+    def test_fork_leases(self):
+        backend = MemoryBackend()
+        options = ThrottlingOptions(backend=backend)
+        rule = ThrottlingRule(max_requests=10, interval=timedelta(seconds=60), lease_size=5)
+        group = BucketGroup([rule], dict(path='path43'), options)
+        self.assertFalse(group.acquire())
+        key = group.buckets[0].base_key
+        capacity = backend.hgetall(key)[b'capacity']
+        connections._after_fork()
+        # the child inherits the atexit handler, parent leases must not be returned twice
+        options.return_leases()
+        self.assertEqual(backend.hgetall(key)[b'capacity'], capacity)
+
+
+class LazyLoadTest(unittest.TestCase):
+    rules = [ThrottlingRule(max_requests=100, interval=timedelta(seconds=60)),
+             ThrottlingRule(max_requests=1, interval=timedelta(seconds=60))]
+
+    def setUp(self):
+        for path in ('path37', 'path38'):
+            clear_buckets(self.rules, dict(path=path))
+
+    def test_strictest_first(self):
+        options = ThrottlingOptions(backend=TEST_BACKEND)
+        arguments = dict(path='path37')
+        buckets = get_buckets(self.rules, arguments, options)
+        self.assertIsNone(buckets[0].cache_dict)
+        self.assertFalse(check_throttle(buckets))
+        commit_request(buckets)
+        buckets = get_buckets(self.rules, arguments, options)
+        self.assertTrue(check_throttle(buckets))
+        # the strict rule throttled the request, the bucket of the loose rule was not read
+        self.assertIsNone(buckets[0].cache_dict)
+        self.assertEqual(buckets[0]._capacity, 99)
+
+    def test_request_buckets(self):
+        options = ThrottlingOptions(backend=TEST_BACKEND)
+        arguments = dict(path='path38')
+        request_buckets = {}
+        self.assertFalse(BucketGroup(self.rules, arguments, options, request_buckets=request_buckets).acquire())
+        # buckets charged earlier within the same request are not charged again
+        group = BucketGroup(self.rules, arguments, options, request_buckets=request_buckets)
+        self.assertFalse(group.acquire())
+        self.assertEqual(group.pending, [])
+        self.assertEqual(group.rate_limit_headers()['X-RateLimit-Remaining'], '0')
+        self.assertTrue(BucketGroup(self.rules, arguments, options).acquire())
+
+    def test_longest_wait(self):
+        now = [1000000.0]
+        options = ThrottlingOptions(backend=MemoryBackend(clock=lambda: now[0]), clock=lambda: now[0])
+        rules = [ThrottlingRule(max_requests=1, interval=timedelta(seconds=1)),
+                 ThrottlingRule(max_requests=100, interval=timedelta(seconds=60))]
+        arguments = dict(path='path42')
+        self.assertFalse(BucketGroup(rules, arguments, options).acquire())
+        group = BucketGroup(rules, arguments, options)
+        options.redis.hset(group.buckets[1].base_key, 'capacity', 0)
+        now[0] += 0.5
+        # the strictest rule waits 0.5s, the looser one 59.5s
+        self.assertEqual(group.acquire(), timedelta(seconds=59.5))
+        self.assertEqual(group.throttled_rules, rules)
+
+
+class SimulationTest(unittest.TestCase):
+
+    def test_replay(self):
+        rule = ThrottlingRule(max_requests=2, interval=timedelta(seconds=10))
+        events = [(1000 + t, {'user': user}) for t, user in ((0, 1), (1, 1), (2, 2), (3, 1), (11, 1), (12, 1))]
+        report = Simulation([rule], purge_interval=2).run(iter(events))
+        # the third request within the interval is throttled, the bucket is refilled after the interval
+        self.assertEqual((report.requests, report.throttled), (6, 1))
+        self.assertEqual(report.key_stats('user;1'), (5, 1))
+        self.assertEqual(report.top_keys(), [('user;1', 5, 1)])
+        self.assertEqual(report.rules[rule], 1)
+        self.assertEqual(report.peak_buckets, 2)
+        self.assertEqual((report.started_at, report.finished_at), (1000, 1012))
+
+    def test_read_events(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'log.csv')
+            with open(path, 'w') as f:
+                f.write('timestamp,user,method\n1000.5,1,GET\n2024-01-01T00:00:00Z,2,POST\n')
+            self.assertEqual(list(read_events(path, arguments=['user'])),
+                             [(1000.5, {'user': '1'}), (1704067200.0, {'user': '2'})])
+
+
 if __name__ == "__main__":
     unittest.main()